@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import platform
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from src.database.database_manager import RSLManager, HUB_DESCRIPTIONS
+
+REFERENCES = os.path.join(ROOT, 'references')
+STAGES = ['create', 'load', 'scrap', 'rework', 'update', 'export', 'analyze']
+
+
+# SYNTHETIC RSL
+def generate_rsl(file_path, rows, seed = 0, year = 2024, lapfusion_share = 0.25, chunk_rows = 500000):
+    # Writes an RSL export with the columns run_rsl expects. Shop orders use the real LapFusion top level P/Ns
+    # (lapfusion_share of them, the rest are other products that get filtered out) and the real DM1 / QC-DM1 codes.
+    # About 60% of the rows scrap the whole device, the rest are component rework, some of it on hubs.
+    # Written chunk_rows at a time so 10M row files do not need 10M rows in memory.
+    rng = np.random.default_rng(seed)
+    models = pd.read_csv(os.path.join(REFERENCES, 'LapFusionModels.csv'), encoding = 'utf-8-sig')
+    codes = pd.concat([
+        pd.read_csv(os.path.join(REFERENCES, 'DM1Codes.csv'), encoding = 'utf-8-sig').assign(Plant = 'DM1'),
+        pd.read_csv(os.path.join(REFERENCES, 'QC-DM1Codes.csv'), encoding = 'utf-8-sig').assign(Plant = 'QC-DM1'),
+    ], ignore_index = True)
+
+    shoporder_count = max(rows // 20, 10)
+    shoporders = pd.DataFrame({
+        'num': 1000000 + rng.choice(8999999, shoporder_count, replace = False),
+        'tl_pn': np.where(rng.random(shoporder_count) < lapfusion_share, rng.choice(models['Material Number'].to_numpy(), shoporder_count),
+                          100000000 + rng.integers(0, 999999, shoporder_count)),
+        'qty': rng.choice([144, 288, 576, 1152, 1920], shoporder_count),
+        'status': np.where(rng.random(shoporder_count) < 0.85, 'Production', 'Engineering'),
+        'start': rng.integers(0, 350, shoporder_count),
+    })
+    hubs = 200000000 + np.arange(3)
+
+    written = 0
+    while written < rows:
+        n = min(chunk_rows, rows - written)
+        so = shoporders.iloc[rng.integers(0, shoporder_count, n)]
+        full = rng.random(n) < 0.6
+        hub = ~full & (rng.random(n) < 0.3)
+        component = np.where(full, so['tl_pn'], np.where(hub, rng.choice(hubs, n), 300000000 + rng.integers(0, 500, n)))
+        code = codes.iloc[rng.integers(0, len(codes), n)]
+        # consecutive rows share an RSL # now and then, like multi line log entries
+        rsl_num = year * 1000000 + written + np.arange(n) - (rng.random(n) < 0.1)
+        date = pd.Timestamp(f"{year}-01-01") + pd.to_timedelta(so['start'].to_numpy() + rng.integers(0, 14, n), unit = 'D')
+
+        df = pd.DataFrame({
+            'RSL #': rsl_num,
+            'Date': date.strftime('%m/%d/%Y'),
+            'Type': np.where(full, 'Scrap', 'Rework'),
+            'Status': so['status'].to_numpy(),
+            'Plant': code['Plant'].to_numpy(),
+            'Shop/Service Order #': so['num'].to_numpy(),
+            'Shop Order Qty': so['qty'].to_numpy().astype(float),
+            'Shop Order P/N': so['tl_pn'].to_numpy().astype(float),
+            'Shop Order P/N Desc': 'ENERGY DEVICE',
+            'Scrap/Rework P/N': component,
+            'Scrap/Rework P/N Desc': np.where(full, 'ENERGY DEVICE', np.where(hub, HUB_DESCRIPTIONS[0], 'COMPONENT')),
+            'Code Id': code['Id'].to_numpy(),
+            'Code': code['Name'].to_numpy(),
+            'Cost': np.round(rng.gamma(2, 20, n), 2),
+            'Scrap/Rework Qty': rng.integers(1, 12, n).astype(float),
+        })
+        df.to_csv(file_path, mode = 'w' if written == 0 else 'a', header = written == 0, index = False)
+        written += n
+    return file_path
+
+
+# BENCHMARK
+def peak_rss_mb():
+    # ru_maxrss is KB on Linux and bytes on macOS, worker processes are counted through RUSAGE_CHILDREN
+    if resource is None:
+        return None
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return round(max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / scale, 1)
+
+def run_benchmark(rows, seed = 0, files = 1, stages = STAGES, workers = None, chunksize = None, file_format = 'csv', work_dir = None):
+    work_dir = work_dir or tempfile.mkdtemp(prefix = 'rsl_benchmark_')
+    os.makedirs(work_dir, exist_ok = True)
+    start = time.perf_counter()
+    rsl_files = [generate_rsl(os.path.join(work_dir, f"RSL_{2024 - i}.csv"), rows // files, seed = seed + i, year = 2024 - i) for i in range(files)]
+    generate_seconds = round(time.perf_counter() - start, 3)
+
+    references = [
+        ('Plants', os.path.join(REFERENCES, 'Plants.csv')),
+        ('Codes', os.path.join(REFERENCES, 'DM1Codes.csv'), 'DM1'),
+        ('Codes', os.path.join(REFERENCES, 'QC-DM1Codes.csv'), 'QC-DM1'),
+        ('Operations', os.path.join(REFERENCES, 'DM1Operations.csv'), 'DM1'),
+        ('Operations', os.path.join(REFERENCES, 'QC-DM1Operations.csv'), 'QC-DM1'),
+        ('Models', os.path.join(REFERENCES, 'LapFusionModels.csv')),
+    ]
+
+    # export writes into ./results, so the run happens inside the work dir
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        manager = RSLManager(os.path.join(work_dir, 'benchmark.db'))
+        manager.open_connection()
+        results = []
+        for stage in stages:
+            timing = manager.run_pipeline([stage], references = references, rsl_files = rsl_files, workers = workers, chunksize = chunksize,
+                                          file_format = file_format, show = False)[-1]
+            timing['rows_per_second'] = round(rows / timing['seconds']) if timing['seconds'] else None
+            timing['peak_rss_mb'] = peak_rss_mb()
+            results.append(timing)
+        manager.curr.execute("""SELECT COUNT(*) FROM RSL""")
+        rsl_rows = manager.curr.fetchone()[0]
+        manager.close_connection()
+    finally:
+        os.chdir(cwd)
+
+    return {
+        'rows': rows,
+        'rsl_rows': rsl_rows,
+        'files': files,
+        'seed': seed,
+        'workers': workers,
+        'chunksize': chunksize,
+        'generate_seconds': generate_seconds,
+        'work_dir': work_dir,
+        'commit': _git_commit(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'sqlite': sqlite3.sqlite_version,
+        'cpus': os.cpu_count(),
+        'stages': results,
+    }
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd = ROOT, capture_output = True, text = True).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(current, previous):
+    # Per stage seconds against an earlier result file, positive change = slower
+    previous_stages = dict([(i['stage'], i) for i in previous['stages']])
+    rows = []
+    for timing in current['stages']:
+        before = previous_stages.get(timing['stage'])
+        change = round((timing['seconds'] - before['seconds']) / before['seconds'] * 100, 1) if before and before['seconds'] else None
+        rows.append({'stage': timing['stage'], 'seconds': timing['seconds'], 'previous': before['seconds'] if before else None, 'change_%': change})
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Times the RSLManager pipeline stages on a synthetic RSL export')
+    parser.add_argument('--rows', type = int, default = 100000, help = 'total RSL rows to generate (10k to 10M)')
+    parser.add_argument('--files', type = int, default = 1, help = 'split the rows over this many yearly files')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--stages', nargs = '+', choices = STAGES, default = STAGES)
+    parser.add_argument('--workers', type = int, default = None)
+    parser.add_argument('--chunksize', type = int, default = None, help = 'stream the RSL files in chunks of this many rows')
+    parser.add_argument('--format', default = 'csv', choices = ['csv', 'parquet', 'feather'], help = 'export file format')
+    parser.add_argument('--work-dir', default = None, help = 'where the generated files and database go (temporary directory by default)')
+    parser.add_argument('--keep', action = 'store_true', help = 'keep the work dir afterwards')
+    parser.add_argument('--out', default = os.path.join(ROOT, 'benchmarks', 'results'), help = 'folder the result JSON is saved in')
+    parser.add_argument('--compare', default = None, help = 'earlier result JSON to compare against')
+    args = parser.parse_args()
+
+    result = run_benchmark(args.rows, seed = args.seed, files = args.files, stages = args.stages, workers = args.workers,
+                           chunksize = args.chunksize, file_format = args.format, work_dir = args.work_dir)
+    if not args.keep:
+        shutil.rmtree(result['work_dir'], ignore_errors = True)
+
+    print()
+    print(pd.DataFrame(result['stages']).to_string(index = False))
+    os.makedirs(args.out, exist_ok = True)
+    out_file = os.path.join(args.out, f"benchmark_{args.rows}_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(out_file, 'w') as f:
+        json.dump(result, f, indent = 2)
+    print(f"\nSaved {out_file}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            print()
+            print(compare(result, json.load(f)).to_string(index = False))
+
+
+
+if __name__ == '__main__':
+    main()
@@ -1,95 +1,58 @@
-import os 
+import os
+import argparse
 from src.database.database_manager import RSLManager
 
-def main():
-    def clear_cheese():
-        if os.path.exists(db_name):
-            os.remove(db_name)
-
-    def create_cheese():
-        MASTER_CHEESE = RSLManager(db_name)
-        MASTER_CHEESE.open_connection()
-        MASTER_CHEESE.create_schema()
-        MASTER_CHEESE.load_references('Plants', plants)
-        MASTER_CHEESE.load_references('Codes', dm1_codes, 'DM1')
-        MASTER_CHEESE.load_references('Codes', qcdm1_codes, 'QC-DM1')
-        MASTER_CHEESE.load_references('Operations', dm1_operations, 'DM1')
-        MASTER_CHEESE.load_references('Operations', qcdm1_operations, 'QC-DM1')
-        MASTER_CHEESE.load_references('Models', models)
-        # cheeseball.input_data(rsl)
+STAGES = ['create', 'load', 'scrap', 'rework', 'update', 'cube', 'reports', 'export', 'analyze', 'render']
 
-    def run_cheese():
-        PARMESAN = RSLManager(db_name)
-        PARMESAN.open_connection() 
-        PARMESAN.run_rsl(rsl_2024)
-        PARMESAN.run_rsl(rsl_2023)
-        PARMESAN.run_rsl(rsl_2022)
-        PARMESAN.run_rsl(rsl_2021)
-        PARMESAN.run_rsl(rsl_2020)
-        PARMESAN.run_rsl(rsl_2019)
-        PARMESAN.close_connection()
-        # cheeseball.analyze_QCscrap()
-        
-    def scrap_cheese():
-        MOZZARELLA = RSLManager(db_name)
-        MOZZARELLA.open_connection()
-        MOZZARELLA.main_scrap_function()
-        MOZZARELLA.close_connection()
-        
-    def rework_cheese():
-        CHEDDAR = RSLManager(db_name)
-        CHEDDAR.open_connection()
-        CHEDDAR.main_rework_function()
-        CHEDDAR.close_connection()
-        
-    def export_cheese():
-        GOUDA = RSLManager(db_name)
-        GOUDA.open_connection()
-        GOUDA.export_table('QCScrapLog')
-        GOUDA.export_table('ProdScrapLog')
-        GOUDA.export_table('ProdReworkLog')
-        GOUDA.close_connection()
-        
-    def update_cheese():
-        ITSWEDNESDAYMYDUDES = RSLManager(db_name)
-        ITSWEDNESDAYMYDUDES.open_connection()
-        ITSWEDNESDAYMYDUDES.main_update_function()
-        ITSWEDNESDAYMYDUDES.close_connection()
-        
-    def analyze_cheese():
-        REEEEEEEEE = RSLManager(db_name)
-        REEEEEEEEE.open_connection()
-        REEEEEEEEE._generate_yield_chart('EB215')
-        REEEEEEEEE.close_connection()
+def main():
+    parser = argparse.ArgumentParser(description = 'LapFusion RSL scrap trending pipeline')
+    parser.add_argument('--stages', nargs = '+', choices = STAGES, default = ['analyze'], help = 'stages to run, in order')
+    parser.add_argument('--rebuild', action = 'store_true', help = 'delete the database first (use with create and load)')
+    parser.add_argument('--incremental', action = 'store_true', help = 'only load RSL rows that are not already in the database')
+    parser.add_argument('--years', nargs = '+', default = ['2024', '2023', '2022', '2021', '2020', '2019'], help = 'RSL_<year>.csv files to load')
+    parser.add_argument('--full', action = 'store_true', help = 'recompute every shop order in the scrap, rework and update stages, not just the ones loads touched')
+    parser.add_argument('--chunksize', type = int, default = None, help = 'stream each RSL file in chunks of this many rows (flat memory, no worker processes)')
+    parser.add_argument('--workers', type = int, default = None, help = 'worker processes for loading and exporting')
+    parser.add_argument('--format', default = 'csv', choices = ['csv', 'parquet', 'feather'], help = 'export file format')
+    parser.add_argument('--models', nargs = '+', default = ['EB215'], help = 'models to analyze')
+    parser.add_argument('--chart-format', default = 'png', choices = ['png', 'svg', 'html'], help = 'file format for the render stage')
+    parser.add_argument('--reports', default = os.path.join(os.getcwd(), 'yieldreport'), help = 'folder of Energy Yield Report workbooks for the reports stage')
+    parser.add_argument('--profile', action = 'store_true', help = 'time every method and SQL statement, report goes to results/profile')
+    parser.add_argument('--db', default = 'LapFusionRSL.db')
+    args = parser.parse_args()
 
-    db_name = 'LapFusionRSL.db'
+    db_name = args.db
 
     plants = os.path.join(os.getcwd(), 'references', 'Plants.csv')
     dm1_codes = os.path.join(os.getcwd(), 'references', 'DM1Codes.csv')
     qcdm1_codes = os.path.join(os.getcwd(), 'references', 'QC-DM1Codes.csv')
     dm1_operations = os.path.join(os.getcwd(), 'references', 'DM1Operations.csv')
     qcdm1_operations = os.path.join(os.getcwd(), 'references', 'QC-DM1Operations.csv')
-    rsl_2024 = os.path.join(os.getcwd(), 'rsl', 'RSL_2024.csv')
-    rsl_2023 = os.path.join(os.getcwd(), 'rsl', 'RSL_2023.csv')
-    rsl_2022 = os.path.join(os.getcwd(), 'rsl', 'RSL_2022.csv')
-    rsl_2021 = os.path.join(os.getcwd(), 'rsl', 'RSL_2021.csv')
-    rsl_2020 = os.path.join(os.getcwd(), 'rsl', 'RSL_2020.csv')
-    rsl_2019 = os.path.join(os.getcwd(), 'rsl', 'RSL_2019.csv')
     models = os.path.join(os.getcwd(), 'references', 'LapFusionModels.csv')
-    
-    # clear_cheese()
-    # create_cheese()
-    # run_cheese()
-    # scrap_cheese()
-    # rework_cheese()
-    # export_cheese()
-    # update_cheese()
-    analyze_cheese()
-    
-    # check_cheese()
-    
+    rsl_files = [os.path.join(os.getcwd(), 'rsl', f"RSL_{year}.csv") for year in args.years]
+
+    references = [
+        ('Plants', plants),
+        ('Codes', dm1_codes, 'DM1'),
+        ('Codes', qcdm1_codes, 'QC-DM1'),
+        ('Operations', dm1_operations, 'DM1'),
+        ('Operations', qcdm1_operations, 'QC-DM1'),
+        ('Models', models),
+    ]
+
+    if args.rebuild:
+        for file_name in [db_name, f"{db_name}-wal", f"{db_name}-shm"]:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+    CHEESE = RSLManager(db_name, profile = args.profile)
+    CHEESE.open_connection()
+    CHEESE.run_pipeline(args.stages, references = references, rsl_files = rsl_files, workers = args.workers,
+                        incremental = args.incremental, file_format = args.format, models = args.models, chart_format = args.chart_format,
+                        chunksize = args.chunksize, report_dir = args.reports, full = args.full)
+    CHEESE.close_connection()
+
 
 
 if __name__ == '__main__':
-    os.system('clear')
     main()
@@ -1,93 +1,573 @@
 import os
-import csv
-import math
+import re
+import time
+import json
+import uuid
+import shutil
+import inspect
+import hashlib
+import functools
 import sqlite3 
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd 
 
 import matplotlib.pyplot as plt
 import plotly.graph_objects as go
+from matplotlib.figure import Figure
+
+HUB_DESCRIPTIONS = ['HUB, 5MM FUSION']
+REWORK_EXCLUDED_CODES = ['Material Overissue', 'Material Underissue', 'Fixed Quantity', 'Defective Components']
+SUMMARY_BUCKETS = ['week', 'month', 'quarter']
+# ShopOrders.so_qty is the RSL Shop Order Qty (kept as so_qty_raw) times this
+SO_QTY_MULTIPLIER = 6
+# Stages that recompute per shop order and keep their own set of dirty shop orders
+DIRTY_STAGES = ['scrap', 'rework', 'update', 'summary']
+CUBE_LOG_TYPES = ['QCScrap', 'ProdScrap', 'ProdRework']
+CUBE_ARRAYS = ['qty', 'cost', 'shoporders', 'model', 'so_qty', 'type', 'first_date']
+# ScrapCodes lists a code id once per plant and the plants may name it differently. Wherever an id is shown or matched
+# by name (reference cache, log views, rework exclusions, reports) it gets this one name, so joins never fan out.
+SCRAP_CODE_NAMES = """SELECT id, MIN(name) AS name FROM ScrapCodes GROUP BY id"""
+# Yield report header labels (lower case, whitespace collapsed): what starts a header row, and other spellings of the columns read
+YIELD_REPORT_HEADERS = ['shop order', 's/o']
+YIELD_REPORT_ALIASES = {'lot size': 's/o qty', 'build quantity': 'build qty'}
+
+# The RSL export columns a streaming load reads: the ones the loader uses plus Type and Code so error rows carry the
+# same fields as a whole file read. Everything is read as str so every chunk gets the same dtypes; numbers are parsed
+# with pd.to_numeric downstream, so a stray bad value only fails its own row (and error rows hold the raw text).
+RSL_COLUMNS = ['RSL #', 'Date', 'Type', 'Status', 'Plant', 'Shop/Service Order #', 'Shop Order Qty', 'Shop Order P/N', 'Shop Order P/N Desc',
+               'Scrap/Rework P/N', 'Scrap/Rework P/N Desc', 'Code Id', 'Code', 'Cost', 'Scrap/Rework Qty']
+RSL_DTYPES = dict([(column, str) for column in RSL_COLUMNS])
+
+def _to_records(df):
+    # executemany wants plain python rows with None for missing values
+    df = df.astype(object).where(df.notna(), None)
+    return list(df.itertuples(index = False, name = None))
+
+def _quote_identifier(name):
+    # Scrap code names become column names and can contain spaces, slashes and quotes
+    return '"' + name.replace('"', '""') + '"'
+
+def _write_frame(df, file_path, file_format):
+    if file_format == 'csv':
+        df.to_csv(file_path, index = False)
+    else:
+        # Model is stored dictionary encoded, the code columns compress down to almost nothing since they are mostly 0
+        df = df.astype({'Model': 'category'}).reset_index(drop = True)
+        if file_format == 'parquet':
+            df.to_parquet(file_path, index = False)
+        elif file_format == 'feather':
+            df.to_feather(file_path)
+        else:
+            raise ValueError(f"Unknown file format: {file_format}")
+
+def load_results(table, model = None, codes = None, file_format = 'parquet', results_dir = None):
+    # Reads exported results back without parsing whole files: only the requested model's file (all models if None)
+    # and, when codes is given, only shoporder, Model and those code columns. Codes a model never had come back as 0.
+    save_path = os.path.join(results_dir or os.path.join(os.getcwd(), 'results'), table)
+    if model is None:
+        file_names = sorted(i for i in os.listdir(save_path) if i.startswith(f"{table}_") and i.endswith(f".{file_format}"))
+    else:
+        file_names = [f"{table}_{model}.{file_format}"]
+    if isinstance(codes, str):
+        codes = [codes]
+    
+    frames = []
+    for file_name in file_names:
+        file_path = os.path.join(save_path, file_name)
+        columns = None
+        if codes is not None:
+            available = _result_columns(file_path, file_format)
+            columns = ['shoporder', 'Model'] + [i for i in codes if i in available]
+        if file_format == 'parquet':
+            frames.append(pd.read_parquet(file_path, columns = columns))
+        elif file_format == 'feather':
+            frames.append(pd.read_feather(file_path, columns = columns))
+        else:
+            frames.append(pd.read_csv(file_path, usecols = columns))
+    
+    df = pd.concat(frames, ignore_index = True) if frames else pd.DataFrame(columns = ['shoporder', 'Model'])
+    if codes is not None:
+        df = df.reindex(columns = ['shoporder', 'Model'] + codes, fill_value = 0)
+    return df
+
+def _result_columns(file_path, file_format):
+    # Column names only, read from the file footer/header
+    if file_format == 'parquet':
+        import pyarrow.parquet
+        return set(pyarrow.parquet.read_schema(file_path).names)
+    elif file_format == 'feather':
+        import pyarrow.ipc
+        return set(pyarrow.ipc.open_file(file_path).schema.names)
+    return set(pd.read_csv(file_path, nrows = 0).columns)
+
+def _chart_paths(model, out_dir, file_format):
+    return [os.path.join(out_dir, f"{model}_{name}.{file_format}") for name in ['yield', 'scrap_pareto', 'rework_pareto']]
+
+def _save_chart(fig, path, file_format):
+    # Written under a temp name and swapped in, so an interrupted render never leaves a partial chart behind
+    temp_path = f"{path}.tmp"
+    if file_format == 'html':
+        fig.write_html(temp_path)
+    else:
+        fig.savefig(temp_path, format = file_format)
+    os.replace(temp_path, path)
+
+def _render_model_charts(model, points, scrap, rework, out_dir, file_format):
+    # Writes <model>_yield, <model>_scrap_pareto and <model>_rework_pareto. Module level so it can run in a worker
+    # process; png/svg are drawn with matplotlib's Figure directly (no pyplot, so no GUI backend), html with plotly.
+    x = points['num'].astype(str)
+    paths = _chart_paths(model, out_dir, file_format)
+    if file_format == 'html':
+        fig = go.Figure()
+        fig.add_trace(go.Scatter(x=x, y=points['yield'], mode='markers+lines', marker=dict(color='blue'), name='Yield'))
+        for column, color in [('center', 'green'), ('ucl', 'red'), ('lcl', 'red')]:
+            fig.add_trace(go.Scatter(x=x, y=points[column], mode='lines', line=dict(color=color, dash='dash'), name=column.upper()))
+        fig.update_layout(title=f"{model} Shop Order Yield", xaxis_title='Shop Orders', yaxis_title='Yield (%)')
+        _save_chart(fig, paths[0], file_format)
+        
+        for path, name, pareto in [(paths[1], 'scrap', scrap), (paths[2], 'rework', rework)]:
+            fig = go.Figure()
+            fig.add_trace(go.Bar(x=pareto.index, y=pareto['qty'], name=name.title()))
+            fig.add_trace(go.Scatter(x=pareto.index, y=pareto['cumulative'], yaxis='y2', mode='lines+markers', name='Cumulative %'))
+            fig.update_layout(title=f"{model} {name.title()} Pareto", yaxis_title='Qty', yaxis2=dict(overlaying='y', side='right', range=[0, 105]))
+            _save_chart(fig, path, file_format)
+        return paths
+    
+    fig = Figure(figsize = (12, 5))
+    ax = fig.subplots()
+    ax.plot(x, points['yield'], '-ob', markersize = 3, label = 'Yield')
+    for column, style in [('center', '--g'), ('ucl', '--r'), ('lcl', '--r')]:
+        ax.plot(x, points[column], style, label = column.upper())
+    ax.set_title(f"{model} Shop Order Yield")
+    ax.set_xlabel('Shop Orders')
+    ax.set_ylabel('Yield (%)')
+    ax.set_xticks(x[::max(len(x) // 20, 1)])
+    ax.tick_params(axis = 'x', labelrotation = 90)
+    ax.legend()
+    fig.tight_layout()
+    _save_chart(fig, paths[0], file_format)
+    
+    for path, name, pareto in [(paths[1], 'scrap', scrap), (paths[2], 'rework', rework)]:
+        fig = Figure(figsize = (12, 6))
+        ax = fig.subplots()
+        ax.bar(pareto.index, pareto['qty'])
+        ax.set_title(f"{model} {name.title()} Pareto")
+        ax.set_ylabel('Qty')
+        ax.tick_params(axis = 'x', labelrotation = 90)
+        if len(pareto):
+            cumulative = ax.twinx()
+            cumulative.plot(pareto.index, pareto['cumulative'], '-or', markersize = 3)
+            cumulative.set_ylim(0, 105)
+            cumulative.set_ylabel('Cumulative (%)')
+        fig.tight_layout()
+        _save_chart(fig, path, file_format)
+    return paths
+
+def _bucket_start(dates, bucket_type):
+    # ISO date (YYYY-MM-DD) of the Monday/first of month/first of quarter each date falls in
+    if bucket_type == 'week':
+        return (dates.dt.normalize() - pd.to_timedelta(dates.dt.weekday, unit = 'D')).dt.strftime('%Y-%m-%d')
+    elif bucket_type in ['month', 'quarter']:
+        return dates.dt.to_period(bucket_type[0].upper()).dt.start_time.dt.strftime('%Y-%m-%d')
+    raise ValueError(f"Unknown bucket: {bucket_type}, expected one of {SUMMARY_BUCKETS}")
+
+def _parse_dates(values):
+    # RSL exports write dates as MM/DD/YYYY, anything else is parsed one by one. Unparseable values become NaT.
+    values = pd.Series(values, dtype = object)
+    dates = pd.to_datetime(values, format = '%m/%d/%Y', errors = 'coerce')
+    retry = dates.isna() & values.notna()
+    if retry.any():
+        dates[retry] = pd.to_datetime(values[retry].astype(str), format = 'mixed', errors = 'coerce')
+    return dates
+
+def _read_rsl(csvfile, tl_pns):
+    # Parses one RSL export and keeps only the rows run_rsl cares about: LapFusion rows plus rows whose
+    # Shop Order P/N is unusable (those go to errors). Module level so it can run in a worker process.
+    df = pd.read_csv(csvfile, low_memory = False)
+    rows_read = len(df)
+    
+    # RSL # can repeat across the lines of one log entry, so each row is keyed on (RSL #, nth line of that RSL #)
+    df['_rsl_num'] = pd.to_numeric(df['RSL #'], errors = 'coerce').astype('Int64')
+    df['_line'] = df.groupby('_rsl_num').cumcount()
+    return _filter_rsl(df, tl_pns), rows_read
+
+def _read_rsl_chunks(csvfile, tl_pns, chunksize):
+    # Streaming version of _read_rsl: yields (filtered chunk, rows read so far) without ever holding more than
+    # chunksize rows of the export. lines counts the rows of every RSL # seen so far in the file (plain ints, one per
+    # RSL #), so an RSL # that shows up again in a later chunk keeps numbering where it left off and the keys match a full read.
+    lines = {}
+    rows_read = 0
+    for df in pd.read_csv(csvfile, usecols = RSL_COLUMNS, dtype = RSL_DTYPES, chunksize = chunksize):
+        rows_read += len(df)
+        df['_rsl_num'] = pd.to_numeric(df['RSL #'], errors = 'coerce').astype('Int64')
+        df['_line'] = df.groupby('_rsl_num').cumcount() + [lines.get(i, 0) for i in df['_rsl_num'].tolist()]
+        for rsl_num, count in df['_rsl_num'].value_counts().items():
+            lines[int(rsl_num)] = lines.get(int(rsl_num), 0) + int(count)
+        yield _filter_rsl(df, tl_pns), rows_read
+
+def _filter_rsl(df, tl_pns):
+    so_pn = pd.to_numeric(df['Shop Order P/N'], errors = 'coerce')
+    bad_pn = so_pn.isna() | np.isinf(so_pn)
+    df['_is_model'] = ~bad_pn & so_pn.where(~bad_pn, 0).astype('int64').isin(tl_pns)
+    return df[bad_pn | df['_is_model']].reset_index(drop = True)
+
+def _file_hash(file_path):
+    sha = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def _read_yield_report(file_path):
+    # Parses one 'Energy Yield Report - YYYY Qn.xlsx'. Each model sheet is a list of shop order blocks: a row with the
+    # shop order, model, quantities, yield and date, followed by one row per non-conformance with its total scrap.
+    # The header row is the first one with a 'Shop Order' or 'S/O' cell anywhere in it (some sheets shift it a column
+    # right of the data); columns are then found by label. Graph sheets have a header but no model column, so none of
+    # their rows read as a shop order. Sheets with shop order rows but no header are returned by name rather than
+    # silently dropped. Module level so it can run in a worker process.
+    import openpyxl
+    
+    workbook = openpyxl.load_workbook(file_path, read_only = True, data_only = True)
+    shoporders = []
+    scrap = []
+    unrecognised = []
+    for sheet in workbook.worksheets:
+        columns = None
+        shoporder = None
+        for row in sheet.iter_rows(values_only = True):
+            if len(row) < 2:
+                continue
+            names = [' '.join(str(i).split()).lower() if isinstance(i, str) else None for i in row]
+            if any([name in YIELD_REPORT_HEADERS for name in names]):
+                # first header wins, blocks further down repeat it
+                if columns is None:
+                    names = [YIELD_REPORT_ALIASES.get(name, name) for name in names]
+                    columns = dict([(name, names.index(name)) for name in ['s/o qty', 'build qty', 'yield', 'yield %', 'date', 'total', 'description'] if name in names])
+                continue
+            if columns is None:
+                if isinstance(row[0], (int, float)) and isinstance(row[1], str) and sheet.title not in unrecognised:
+                    unrecognised.append(sheet.title)
+                continue
+            value = lambda name: row[columns[name]] if name in columns and columns[name] < len(row) else None
+            if isinstance(row[0], (int, float)) and isinstance(row[1], str):
+                shoporder = int(row[0])
+                date = value('date')
+                shoporders.append({'shoporder': shoporder, 'model': row[1].strip(), 'sheet': sheet.title, 'so_qty': value('s/o qty'), 'build_qty': value('build qty'),
+                                   'good_qty': value('yield'), 'yield_pct': value('yield %'), 'date': date.strftime('%Y-%m-%d') if hasattr(date, 'strftime') else None})
+            elif value('date') == 'Total':
+                shoporder = None
+            elif shoporder is not None and isinstance(value('description'), str) and isinstance(value('total'), (int, float)):
+                scrap.append({'shoporder': shoporder, 'description': value('description').strip(), 'qty': value('total')})
+    workbook.close()
+    
+    shoporders = pd.DataFrame(shoporders, columns = ['shoporder', 'model', 'sheet', 'so_qty', 'build_qty', 'good_qty', 'yield_pct', 'date'])
+    for column in ['so_qty', 'build_qty', 'good_qty', 'yield_pct']:
+        shoporders[column] = pd.to_numeric(shoporders[column], errors = 'coerce')
+    # the workbooks store yield as a fraction, the rest of the pipeline uses percent
+    shoporders['yield_pct'] = shoporders['yield_pct'] * 100
+    scrap = pd.DataFrame(scrap, columns = ['shoporder', 'description', 'qty'])
+    scrap = scrap.groupby(['shoporder', 'description'], as_index = False, sort = False)['qty'].sum()
+    return shoporders, scrap, unrecognised
+
+def load_scrap_cube(cube_dir = None):
+    # Opens the arrays written by RSLManager.build_scrap_cube memory mapped (read only), so any number of processes
+    # share the same pages. qty/cost are (shop order, log type, code name), shop orders are sorted by model then number
+    # and cube['models'][model] is that model's [start, stop) row range, so cube['qty'][start:stop] is a view, not a copy.
+    # The build named in cube_dir/current is read, and every array has to have the shape its meta.json recorded.
+    cube_dir = cube_dir or os.path.join(os.getcwd(), 'results', 'cube')
+    with open(os.path.join(cube_dir, 'current')) as f:
+        build_dir = os.path.join(cube_dir, f.read().strip())
+    with open(os.path.join(build_dir, 'meta.json')) as f:
+        cube = json.load(f)
+    for name in CUBE_ARRAYS:
+        cube[name] = np.load(os.path.join(build_dir, f"{name}.npy"), mmap_mode = 'r')
+        if list(cube[name].shape) != cube['shapes'][name]:
+            raise ValueError(f"Scrap cube {cube['build_id']}: {name}.npy has shape {list(cube[name].shape)}, meta.json expects {cube['shapes'][name]}")
+    return cube
+
+def cube_yield(cube, model, so_type = 'Production'):
+    # Same yield as compute_yield_spc (scrap = QC + Prod scrap) for one model's shop orders, straight from the cube
+    start, stop = cube['models'][model]
+    scrap = cube['qty'][start:stop, :2].sum(axis = (1, 2), dtype = np.float64)
+    so_qty = cube['so_qty'][start:stop]
+    keep = (cube['type'][start:stop] == cube['types'].index(so_type)) & (so_qty != 0)
+    return pd.DataFrame({
+        'num': cube['shoporders'][start:stop][keep],
+        'yield': np.round(np.abs((scrap[keep] - so_qty[keep]) / so_qty[keep] * 100), 2),
+    })
+
+def cube_pareto(cube, model = None, log_types = None, value = 'qty', top = None):
+    # Code name Pareto (value = 'qty' or 'cost') for one model (all if None) and some of the log types (all if None)
+    start, stop = cube['models'][model] if model is not None else (0, len(cube['shoporders']))
+    logs = [cube['log_types'].index(i) for i in log_types or cube['log_types']]
+    totals = cube[value][start:stop][:, logs].sum(axis = (0, 1), dtype = np.float64)
+    if value == 'cost':
+        # cells are float32, back to cents after summing in float64
+        totals = totals.round(2)
+    df = pd.DataFrame({'code': cube['codes'], value: totals})
+    df = df[df[value] > 0].sort_values(value, ascending = False, kind = 'stable').reset_index(drop = True)
+    df['cumulative'] = df[value].cumsum() / df[value].sum() * 100
+    return df.head(top) if top else df
+
+def _normalize_sql(sql):
+    # Groups statements that only differ in literals, whitespace or the length of an IN list
+    sql = re.sub(r"\s+", ' ', sql).strip()
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r"\b\d+(?:\.\d+)?\b", '?', sql)
+    return re.sub(r"IN \(\?(?:, ?\?)*\)", 'IN (...)', sql)
+
+class _Profiler:
+    # Collects per statement and per method timings for RSLManager(profile = True). Method frames are kept on a stack
+    # so every second ends up in exactly one folded stack line (self time), SQL time as a 'SQL ...' leaf under its caller.
+    def __init__(self):
+        self.statements = {}
+        self.functions = {}
+        self.folded = {}
+        self.stack = []
+        
+    def wrap(self, name, method):
+        @functools.wraps(method)
+        def wrapped(*args, **kwargs):
+            self.stack.append([name, 0.0])
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                child_seconds = self.stack.pop()[1]
+                self._add_folded(name, seconds - child_seconds)
+                stats = self.functions.setdefault(name, {'calls': 0, 'seconds': 0.0, 'self_seconds': 0.0})
+                stats['calls'] += 1
+                stats['seconds'] += seconds
+                stats['self_seconds'] += seconds - child_seconds
+                if self.stack:
+                    self.stack[-1][1] += seconds
+        return wrapped
+    
+    def _statement(self, sql):
+        return self.statements.setdefault(_normalize_sql(sql), {'calls': 0, 'executions': 0, 'seconds': 0.0, 'rows_read': 0, 'rows_written': 0})
+    
+    def _add_folded(self, leaf, seconds):
+        path = ';'.join([i[0] for i in self.stack] + [leaf.replace(';', ',')])
+        self.folded[path] = self.folded.get(path, 0.0) + seconds
+    
+    def record_sql(self, sql, seconds, rows_read = 0, rows_written = 0, call = True):
+        stats = self._statement(sql)
+        stats['calls'] += call
+        stats['seconds'] += seconds
+        stats['rows_read'] += rows_read
+        stats['rows_written'] += rows_written
+        self._add_folded('SQL ' + _normalize_sql(sql)[:80], seconds)
+        if self.stack:
+            self.stack[-1][1] += seconds
+    
+    def trace(self, sql):
+        # sqlite3 trace callback, sees every statement the connection runs (pandas reads and each executemany row included)
+        self._statement(sql)['executions'] += 1
+    
+    def report(self):
+        statements = [dict(sql = sql, **stats) for sql, stats in self.statements.items()]
+        functions = [dict(name = name, **stats) for name, stats in self.functions.items()]
+        return {
+            'functions': sorted(functions, key = lambda i: i['seconds'], reverse = True),
+            'statements': sorted(statements, key = lambda i: i['seconds'], reverse = True),
+        }
+    
+    def folded_lines(self):
+        # Brendan Gregg's folded stack format (microseconds), for flamegraph.pl / speedscope
+        return [f"{path} {round(seconds * 1e6)}" for path, seconds in sorted(self.folded.items()) if round(seconds * 1e6) > 0]
+
+class _ProfiledCursor:
+    # Times execute/executemany and the fetches that follow them, everything else goes to the real cursor
+    def __init__(self, cursor, profiler):
+        self._cursor = cursor
+        self._profiler = profiler
+        self._sql = None
+        
+    def execute(self, sql, parameters = ()):
+        return self._run(self._cursor.execute, sql, parameters)
+    
+    def executemany(self, sql, parameters):
+        return self._run(self._cursor.executemany, sql, parameters)
+    
+    def _run(self, method, sql, parameters):
+        changes = self._cursor.connection.total_changes
+        start = time.perf_counter()
+        method(sql, parameters)
+        self._profiler.record_sql(sql, time.perf_counter() - start, rows_written = self._cursor.connection.total_changes - changes)
+        self._sql = sql
+        return self
+    
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self._cursor.fetchall()
+        self._profiler.record_sql(self._sql, time.perf_counter() - start, rows_read = len(rows), call = False)
+        return rows
+    
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self._cursor.fetchone()
+        self._profiler.record_sql(self._sql, time.perf_counter() - start, rows_read = row is not None, call = False)
+        return row
+    
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
 
 class RSLManager:
-    def __init__(self, db_name):
+    def __init__(self, db_name, hub_descriptions = None, rework_excluded_codes = None, profile = False):
         self.name = db_name
         self.database = None
         self.curr = None
         self.change_log = []
         self.errors = []
+        self.references = None
+        self.timings = []
+        # Rework attribution rules: component rework counts when the component is a hub and the code is not excluded.
+        # Changing them only affects rows summarized afterwards, run refresh_summary(full = True) to apply them to history.
+        self.hub_descriptions = list(HUB_DESCRIPTIONS if hub_descriptions is None else hub_descriptions)
+        self.rework_excluded_codes = list(REWORK_EXCLUDED_CODES if rework_excluded_codes is None else rework_excluded_codes)
+        # profile = True times every method and SQL statement, the report is written by close_connection
+        self.profile = profile
+        self.profiler = None
 
     # GENERAL DATABASE FUNCTIONS
     def open_connection(self):
         try:
             self.database = sqlite3.connect(self.name)
             self.curr = self.database.cursor()
+            if self.profile:
+                self._enable_profiling()
+            self._tune_connection()
             # print(f"\nConnected to {self.name}")
         except Exception as e:
             # print(f"Connection Failed: {e}")
             pass
         
+    def _tune_connection(self):
+        # WAL + synchronous=NORMAL only fsyncs at checkpoints instead of on every commit
+        self.curr.execute("""PRAGMA journal_mode = WAL""")
+        self.curr.execute("""PRAGMA synchronous = NORMAL""")
+        self.curr.execute("""PRAGMA cache_size = -65536""") # 64 MB
+        self.curr.execute("""PRAGMA temp_store = MEMORY""")
+        
     def close_connection(self):
+        if self.profiler:
+            self.write_profile()
         self.database.close()
                 
     def commit_changes(self):
         if self.database:
             self.database.commit()
 
+    # PROFILING FUNCTIONS
+    def _enable_profiling(self):
+        if self.profiler is None:
+            self.profiler = _Profiler()
+            # every method (public stages and private helpers) is shadowed by a timed wrapper on this instance
+            for name, method in inspect.getmembers(type(self), inspect.isfunction):
+                if not name.startswith('__') and name not in ['open_connection', 'close_connection', '_enable_profiling', 'write_profile', '_read_sql']:
+                    setattr(self, name, self.profiler.wrap(name, getattr(self, name)))
+        self.curr = _ProfiledCursor(self.curr, self.profiler)
+        self.database.set_trace_callback(self.profiler.trace)
+        
+    def _read_sql(self, sql, params = None):
+        # Every pandas read goes through here so the profiler sees its time and rows like a cursor statement
+        if self.profiler is None:
+            return pd.read_sql_query(sql, self.database, params = params)
+        start = time.perf_counter()
+        df = pd.read_sql_query(sql, self.database, params = params)
+        self.profiler.record_sql(sql, time.perf_counter() - start, rows_read = len(df))
+        return df
+        
+    def write_profile(self, out_dir = None):
+        # results/profile/<db>_<time>.json (stage timings, per method and per statement totals) and .folded (flamegraph input)
+        out_dir = out_dir or os.path.join(os.getcwd(), 'results', 'profile')
+        os.makedirs(out_dir, exist_ok = True)
+        file_name = os.path.join(out_dir, f"{os.path.splitext(os.path.basename(self.name))[0]}_{time.strftime('%Y%m%d_%H%M%S')}")
+        report = dict(database = self.name, created_at = time.strftime('%Y-%m-%dT%H:%M:%S'), stages = self.timings, **self.profiler.report())
+        with open(f"{file_name}.json", 'w') as f:
+            json.dump(report, f, indent = 2)
+        with open(f"{file_name}.folded", 'w') as f:
+            f.write('\n'.join(self.profiler.folded_lines()) + '\n')
+        
+        for i in report['statements'][:10]:
+            print(f"{i['seconds']:>9.3f} s {i['calls']:>7} calls {i['executions']:>9} runs {i['rows_read']:>9} read {i['rows_written']:>9} written  {i['sql'][:90]}")
+        return report
+    
+    # PIPELINE FUNCTIONS
+    def run_pipeline(self, stages, references = None, rsl_files = None, workers = None, incremental = False, file_format = 'csv', models = None, chart_format = 'png', chunksize = None,
+                     report_dir = 'yieldreport', show = True, full = False):
+        # Runs the chosen stages in order over this one connection, committing once per stage.
+        # references is a list of load_references arguments, e.g. [('Codes', 'references/DM1Codes.csv', 'DM1'), ...]
+        stage_functions = {
+            'create': lambda: self._create_stage(references or []),
+            'load': lambda: self._load_stage(rsl_files or [], workers, incremental, chunksize),
+            'scrap': lambda: self.main_scrap_function(full = full),
+            'rework': lambda: self.main_rework_function(full = full),
+            'update': lambda: self.main_update_function(full = full),
+            'reports': lambda: self.load_yield_reports(report_dir, workers = workers),
+            'cube': self.build_scrap_cube,
+            'export': lambda: [self.export_table(table, workers = workers, file_format = file_format) for table in ['QCScrapLog', 'ProdScrapLog', 'ProdReworkLog']],
+            'analyze': lambda: self.main_analysis_function(models, show = show),
+            'render': lambda: self.render_charts(workers = workers, file_format = chart_format),
+        }
+        unknown = [i for i in stages if i not in stage_functions]
+        if unknown:
+            raise ValueError(f"Unknown pipeline stages: {unknown}, expected some of {list(stage_functions)}")
+        
+        for stage in stages:
+            start = time.perf_counter()
+            changes = self.database.total_changes
+            stage_functions[stage]()
+            self.commit_changes()
+            timing = {'stage': stage, 'seconds': round(time.perf_counter() - start, 3), 'rows': self.database.total_changes - changes}
+            self.timings.append(timing)
+            print(f"{timing['stage']:<8} {timing['seconds']:>9.3f} s {timing['rows']:>10} rows")
+        return self.timings
+    
+    def _create_stage(self, references):
+        self.create_schema()
+        for reference in references:
+            self.load_references(*reference)
+            
+    def _load_stage(self, rsl_files, workers, incremental, chunksize):
+        # Streaming reads one file at a time in this process, otherwise whole files are parsed in parallel
+        if chunksize:
+            for csvfile in rsl_files:
+                self.run_rsl(csvfile, incremental = incremental, chunksize = chunksize)
+        else:
+            self.run_rsl_parallel(rsl_files, workers = workers, incremental = incremental)
+        
     # CSV FUNCTIONS
-    def export_table(self, table):
+    def export_table(self, table, workers = None, file_format = 'csv'):
+        # Reads the log once with the model joined in, drops the all-zero code columns and writes
+        # results/<table>/<table>_<model>.<file_format> for every LapFusion model (empty file if a model has no shop orders).
+        # file_format is 'csv', 'parquet' or 'feather', the columnar files are read back with load_results
         if (self.database and self.curr) != None:
-            self.curr.execute(f"""SELECT * FROM {table}""")
-            rows = self.curr.fetchall()
-            
-            csv_name = f"{table}.csv"
-            with open (csv_name, "w") as csvfile:
-                csv_writer = csv.writer(csvfile, delimiter = ",")
-                csv_writer.writerow(i[0] for i in self.curr.description)
-                for row in rows:
-                    csv_writer.writerow(row)
-                    
-            self._remove_blank_columns(csv_name)
-            self._add_device_models(csv_name)
-            self._generate_model_csv(csv_name, table)
-            self._delete_main_csv(csv_name)
-                            
-    def _remove_blank_columns(self, csvfile):
-        df = pd.read_csv(csvfile)
-        df = df.loc[:, (df != 0).any(axis=0)]
-        df.to_csv(csvfile)
-        
-    def _add_device_models(self, csvfile):
-        df = pd.read_csv(csvfile)
-        model_list = []
-        for index, val in df.iterrows():
-            # print(f"\n{val.loc['shoporder']}")
-            self.curr.execute("""SELECT model FROM ShopOrders INNER JOIN LapFusionModels ON LapFusionModels.tl_pn = ShopOrders.tl_pn WHERE ShopOrders.num = ?""", (int(val.loc['shoporder']), ))
-            model_list.append(self.curr.fetchone()[0])
-        df.insert(2, 'Model', model_list, True)
-        df.to_csv(csvfile, index = False)
-        
-    def _generate_model_csv(self, csvfile, table):
-        og_df = pd.read_csv(csvfile)
-        columns = og_df.columns
-        self.curr.execute("""SELECT * FROM LapFusionModels""")
-        models = [i[1] for i in self.curr.fetchall()]
-        models = list(set(models))
-        
-        for model in models:
-            file_name = f"{csvfile[:-4]}_{model}.csv"
-            try:
-                df = og_df[og_df['Model'] == model]
-            except:
-                df = pd.DataFrame(columns = columns)
+            df = self._read_sql(
+                f"""
+                SELECT {table}.*, LapFusionModels.model AS Model
+                FROM {table}
+                INNER JOIN ShopOrders ON ShopOrders.num = {table}.shoporder
+                LEFT JOIN LapFusionModels ON LapFusionModels.tl_pn = ShopOrders.tl_pn
+                """)
+            df.insert(1, 'Model', df.pop('Model'))
+            df = df.loc[:, (df != 0).any(axis = 0)]
             
             save_path = os.path.join(os.getcwd(), 'results', table)
-            file_name = f"{csvfile[:-4]}_{model}.csv"
-            file_path = os.path.join(save_path, file_name)
-            df.to_csv(file_path, index = False)
+            os.makedirs(save_path, exist_ok = True)
+            groups = dict(tuple(df.groupby('Model', sort = False)))
+            models = sorted(set(self._get_references()['models'].values()))
+            frames = [groups.get(model, df.iloc[0:0]) for model in models]
+            file_paths = [os.path.join(save_path, f"{table}_{model}.{file_format}") for model in models]
             
-    def _delete_main_csv(self, csvfile):
-        csv_path = os.path.join(os.getcwd(), csvfile)
-        os.remove(csv_path)
+            if workers:
+                with ProcessPoolExecutor(max_workers = workers) as pool:
+                    list(pool.map(_write_frame, frames, file_paths, [file_format] * len(frames)))
+            else:
+                for frame, file_path in zip(frames, file_paths):
+                    _write_frame(frame, file_path, file_format)
     
         
     # SCHEMA FUNCTION
@@ -100,6 +580,9 @@ class RSLManager:
             self._create_components_table()
             self._create_plant_table()
             self._create_operations_table()
+            self._create_rslloads_tables()
+            self._create_indexes()
+            self._migrate_rsl_dates()
 
     def _create_rsl_table(self):
         self.curr.execute(
@@ -107,6 +590,7 @@ class RSLManager:
             CREATE TABLE IF NOT EXISTS RSL (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             date DATE NOT NULL,
+            month TEXT,
             so INTEGER(7) NOT NULL,
             component_pn INTEGER(9) NOT NULL,
             scrap_code INTEGER(3) NOT NULL,
@@ -132,6 +616,11 @@ class RSLManager:
             scrap_qty INTEGER DEFAULT 0 NOT NULL,
             rework_qty INTEGER DEFAULT 0 NOT NULL,
             type TEXT,
+            so_qty_raw INTEGER,
+            first_date DATE,
+            last_date DATE,
+            scrap_cost REAL DEFAULT 0 NOT NULL,
+            rework_cost REAL DEFAULT 0 NOT NULL,
             FOREIGN KEY(tl_pn) REFERENCES LapFusionModels(tl_pn)
             )
             """
@@ -192,6 +681,112 @@ class RSLManager:
             )
             """
         )
+        
+    def _create_rslloads_tables(self):
+        self.curr.execute(
+            """
+            CREATE TABLE IF NOT EXISTS RSLLoads (
+            source TEXT PRIMARY KEY NOT NULL,
+            file_size INTEGER NOT NULL,
+            file_mtime REAL NOT NULL,
+            rows_read INTEGER NOT NULL,
+            rows_loaded INTEGER NOT NULL,
+            max_rsl_num INTEGER,
+            loaded_at TEXT NOT NULL
+            )
+            """
+        )
+        
+        self.curr.execute(
+            """
+            CREATE TABLE IF NOT EXISTS RSLKeys (
+            rsl_num INTEGER NOT NULL,
+            line INTEGER NOT NULL,
+            source TEXT NOT NULL,
+            PRIMARY KEY (rsl_num, line),
+            FOREIGN KEY (source) REFERENCES RSLLoads(source)
+            )
+            """
+        )
+    
+    def _create_indexes(self):
+        # Secondary indexes for the per shop order lookups in the scrap, rework and update stages
+        self.curr.execute("""CREATE INDEX IF NOT EXISTS RSL_so_component ON RSL (so, component_pn)""")
+        self.curr.execute("""CREATE INDEX IF NOT EXISTS RSL_code_plant ON RSL (scrap_code, plant)""")
+        self.curr.execute("""CREATE INDEX IF NOT EXISTS ShopOrders_tl_pn ON ShopOrders (tl_pn)""")
+        self.curr.execute("""CREATE INDEX IF NOT EXISTS Components_description ON Components (description)""")
+        self.curr.execute("""CREATE INDEX IF NOT EXISTS LapFusionModels_model ON LapFusionModels (model)""")
+        
+    def _migrate_rsl_dates(self):
+        # RSL.date is ISO (YYYY-MM-DD) with month (YYYY-MM) as the partition key, ShopOrders gets its first/last RSL date.
+        # Rows loaded before that still hold the export's MM/DD/YYYY string and are converted once.
+        self._create_summary_tables()
+        self._add_missing_columns('RSL', {'month': 'TEXT'})
+        self._add_missing_columns('ShopOrders', {'first_date': 'DATE', 'last_date': 'DATE'})
+        self.curr.execute("""CREATE INDEX IF NOT EXISTS RSL_date ON RSL (date)""")
+        self.curr.execute("""CREATE INDEX IF NOT EXISTS RSL_month ON RSL (month)""")
+        self.curr.execute("""CREATE INDEX IF NOT EXISTS ShopOrders_first_date ON ShopOrders (first_date)""")
+        self.curr.execute("""SELECT value FROM Watermarks WHERE name = 'RSLDates'""")
+        if not self.curr.fetchone():
+            self.curr.execute("""SELECT id, date FROM RSL WHERE month IS NULL""")
+            rows = pd.DataFrame(self.curr.fetchall(), columns = ['id', 'date'])
+            dates = _parse_dates(rows['date'])
+            # unparseable dates keep their original text and no month
+            rows['month'] = dates.dt.strftime('%Y-%m').where(dates.notna(), None)
+            rows['date'] = dates.dt.strftime('%Y-%m-%d').where(dates.notna(), rows['date'])
+            self.curr.executemany("""UPDATE RSL SET date = ?, month = ? WHERE id = ?""", _to_records(rows[['date', 'month', 'id']]))
+            self.curr.execute("""INSERT OR REPLACE INTO Watermarks (name, value) VALUES ('RSLDates', 1)""")
+        
+        # _bulk_insert_rsl keeps the first/last dates current, shop orders loaded before it did (and not updated since) are filled in once
+        self.curr.execute("""SELECT value FROM Watermarks WHERE name = 'ShopOrderDates'""")
+        if self.curr.fetchone():
+            return
+        self.curr.execute("""UPDATE ShopOrders SET first_date = dates.first_date, last_date = dates.last_date
+            FROM (SELECT so, MIN(date) AS first_date, MAX(date) AS last_date FROM RSL WHERE month IS NOT NULL GROUP BY so) AS dates
+            WHERE dates.so = ShopOrders.num""")
+        self.curr.execute("""INSERT OR REPLACE INTO Watermarks (name, value) VALUES ('ShopOrderDates', 1)""")
+        
+    def check_query_plans(self):
+        # EXPLAIN QUERY PLAN for the hot lookups, any 'SCAN' of a table without an index is a full table scan
+        queries = {
+            'full device scrap': ("""SELECT scrap_code, scrap_qty FROM RSL WHERE so = ? AND component_pn = ?""", (0, 0)),
+            'component scrap': ("""SELECT component_pn, scrap_code, scrap_qty FROM RSL WHERE so = ? AND component_pn != ?""", (0, 0)),
+            'scrap by code': ("""SELECT so, scrap_qty FROM RSL WHERE scrap_code = ? AND plant = ?""", (0, 'DM1')),
+            'component lookup': ("""SELECT description FROM Components WHERE component_pn = ? AND tl_pn = ?""", (0, 0)),
+            'hub components': ("""SELECT component_pn FROM Components WHERE description = ?""", ('HUB, 5MM FUSION', )),
+            'model shop orders': ("""SELECT num FROM ShopOrders JOIN LapFusionModels ON LapFusionModels.tl_pn = ShopOrders.tl_pn WHERE LapFusionModels.model = ?""", ('EB215', )),
+            'shop order totals': ("""SELECT SUM(qty) FROM ScrapFacts WHERE shoporder = ? AND log_type = ?""", (0, 'ProdRework')),
+            'code totals': ("""SELECT shoporder, qty FROM ScrapFacts WHERE log_type = ? AND code_id = ?""", ('QCScrap', 0)),
+        }
+        
+        plans = {}
+        for name, (query, params) in queries.items():
+            try:
+                self.curr.execute(f"""EXPLAIN QUERY PLAN {query}""", params)
+                plans[name] = [i[3] for i in self.curr.fetchall()]
+            except sqlite3.OperationalError as e: # ScrapFacts only exists after the scrap/rework stages
+                plans[name] = [str(e)]
+            scans = [i for i in plans[name] if i.startswith('SCAN') and 'INDEX' not in i]
+            print(f"{name}: {'; '.join(plans[name])}{' <-- TABLE SCAN' if scans else ''}")
+        return plans
+    
+    # REFERENCE CACHE FUNCTIONS
+    def _get_references(self):
+        # LapFusionModels, ScrapCodes and Components are small dimension tables, so they are read once
+        # and served from memory until load_references or run_rsl resets self.references
+        if self.references is None:
+            self.curr.execute("""SELECT tl_pn, model FROM LapFusionModels""")
+            models = dict(self.curr.fetchall())
+            self.curr.execute(SCRAP_CODE_NAMES)
+            codes = dict(self.curr.fetchall())
+            self.curr.execute("""SELECT component_pn, tl_pn, description FROM Components""")
+            components = {(component_pn, tl_pn): description for component_pn, tl_pn, description in self.curr.fetchall()}
+            self.references = {
+                'models': models,
+                'codes': codes,
+                'components': components,
+            }
+        return self.references
     
     # REFERENCE TABLE FUNCTIONS
     def load_references(self, ref_type, file_path, plant = None):
@@ -204,179 +799,384 @@ class RSLManager:
         elif (ref_type == 'Models' and plant == None):
             self._load_models(file_path)
         self.commit_changes()
+        self.references = None
         
     def _load_plants(self, filepath):
-        df = pd.read_csv(filepath)
-        for index, val in df.iterrows():
-            _id = val.iloc[0]
-            _name = val.iloc[1]
-            _obsolete = val.iloc[2]
-            if _obsolete is False:
-                self.curr.execute("""INSERT INTO Plants (name) VALUES (?)""", (_name, ))
+        df = self._read_reference(filepath, ['Id', 'Name', 'Obsolete'])
+        df = df[~self._obsolete_mask(df) & df['Name'].notna()]
+        self._upsert_reference(filepath, 'Plants', df[['Name']].rename(columns = {'Name': 'name'}), ['name'])
     
     def _load_codes(self, filepath, plant):
-        df = pd.read_csv(filepath)
-        for index, val in df.iterrows():
-            _id = val.iloc[0]
-            _name = val.iloc[1]
-            _obsolete = val.iloc[2]
-            _fileid = val.iloc[3]
-            if math.isnan(_id) is False:
-                try:
-                    self.curr.execute("""INSERT INTO ScrapCodes (id, name, plant) VALUES (?, ?, ?)""", (_id, _name, plant))
-                except Exception as e:
-                    pass
+        # Obsolete codes are kept, old RSL rows still reference them
+        df = self._read_reference(filepath, ['Id', 'Name', 'Obsolete', 'FileId'])
+        ids = pd.to_numeric(df['Id'], errors = 'coerce').astype('Int64')
+        valid = ids.notna() & df['Name'].notna()
+        df = df[['Id', 'Name']].rename(columns = {'Id': 'id', 'Name': 'name'}).assign(plant = plant)
+        self._upsert_reference(filepath, 'ScrapCodes', df[valid].assign(id = ids[valid]), ['id', 'plant'], invalid = df[~valid])
     
     def _load_operations(self, filepath, plant):
-        df = pd.read_csv(filepath)
-        for index, val in df.iterrows():
-            _id = val.iloc[0]
-            _name = val.iloc[1]
-            _obsolete = val.iloc[2]
-            if (_obsolete is False and math.isnan(_name) is False and plant != None):
-                _name = f"{str(int(_name))}".zfill(4)
-                self.curr.execute("""INSERT INTO Operations (name, plant) VALUES (?, ?)""", (_name, plant))
+        df = self._read_reference(filepath, ['Id', 'Name', 'Obsolete'])
+        df = df[~self._obsolete_mask(df) & df['Name'].notna()]
+        df['Name'] = df['Name'].str.strip().str.zfill(4)
+        self._upsert_reference(filepath, 'Operations', df[['Name']].rename(columns = {'Name': 'name'}).assign(plant = plant), ['name', 'plant'])
             
     def _load_models(self, filepath):
-        df = pd.read_csv(filepath)
-        for index, val in df.iterrows():
-            _model = val.iloc[0]
-            _matnum = val.iloc[1]
-            self.curr.execute("""INSERT INTO LapFusionModels (tl_pn, model) VALUES (?, ?)""", (_matnum, _model))
+        df = self._read_reference(filepath, ['Model', 'Material Number'])
+        tl_pns = pd.to_numeric(df['Material Number'], errors = 'coerce').astype('Int64')
+        valid = tl_pns.notna() & df['Model'].notna()
+        df = df.rename(columns = {'Material Number': 'tl_pn', 'Model': 'model'})[['tl_pn', 'model']]
+        self._upsert_reference(filepath, 'LapFusionModels', df[valid].assign(tl_pn = tl_pns[valid]), ['tl_pn'], invalid = df[~valid])
+        
+    def _read_reference(self, filepath, columns):
+        # The reference exports start with a UTF-8 BOM. Everything is read as text and converted explicitly.
+        df = pd.read_csv(filepath, encoding = 'utf-8-sig', dtype = str)
+        df.columns = df.columns.str.strip()
+        return df[columns]
+    
+    def _obsolete_mask(self, df):
+        return df['Obsolete'].fillna('FALSE').str.strip().str.upper().isin(['TRUE', '1', 'YES'])
+    
+    def _upsert_reference(self, filepath, table, df, key, invalid = None):
+        # First row wins for keys repeated in the file, rows that already exist are updated to the file's values.
+        # Repeats ('duplicate' if identical, 'conflict' if not), updated rows ('changed') and rows the loader dropped
+        # for a missing or non-numeric key or name ('invalid', as read from the file) are reported in change_log.
+        source = os.path.basename(filepath)
+        values = [i for i in df.columns if i not in key]
+        issues = []
+        if invalid is not None and not invalid.empty:
+            issues.append(invalid.assign(issue = 'invalid'))
+        
+        repeated = df[df.duplicated(key, keep = False)]
+        if not repeated.empty:
+            conflicting = repeated.groupby(key)[values].transform('nunique').gt(1).any(axis = 1) if values else pd.Series(False, index = repeated.index)
+            issues.append(repeated.assign(issue = np.where(conflicting, 'conflict', 'duplicate')))
+        df = df.drop_duplicates(key)
+        
+        if values:
+            existing = self._read_sql(f"""SELECT {', '.join(key + values)} FROM {table}""")
+            merged = df.merge(existing.astype(df.dtypes.to_dict()), on = key, suffixes = ('', '_old'))
+            changed = (merged[values].to_numpy() != merged[[i + '_old' for i in values]].to_numpy()).any(axis = 1)
+            if changed.any():
+                issues.append(merged[changed].assign(issue = 'changed'))
+            on_conflict = f"""DO UPDATE SET {', '.join([f'{i} = excluded.{i}' for i in values])}"""
+        else:
+            on_conflict = """DO NOTHING"""
+        
+        self.curr.executemany(
+            f"""INSERT INTO {table} ({', '.join(df.columns)}) VALUES ({', '.join(['?'] * len(df.columns))}) ON CONFLICT ({', '.join(key)}) {on_conflict}""",
+            _to_records(df))
+        
+        for issue in issues:
+            self.change_log.extend(issue.assign(table = table, source = source).to_dict('records'))
+        if issues:
+            counts = pd.concat(issues)['issue'].value_counts()
+            print(f"{table} ({source}): " + ', '.join([f"{count} {issue}" for issue, count in counts.items()]))
     
     # RSL FUNCTIONS            
-    def run_rsl(self, csvfile):
-        df = pd.read_csv(csvfile, low_memory = False)
-        for index, val in df.iterrows():
-            _rsl_num = val.loc['RSL #']
-            _date = val.loc['Date']
-            _type = val.loc['Type']
-            _status = val.loc['Status']
-            _plant = val.loc['Plant']
-            _so = val.loc['Shop/Service Order #']
-            _so_qty = val.loc['Shop Order Qty']
-            _so_pn = val.loc['Shop Order P/N']
-            _so_desc = val.loc['Shop Order P/N Desc']
-            _scrap_pn = val.loc['Scrap/Rework P/N']
-            _scrap_desc = val.loc['Scrap/Rework P/N Desc']
-            _scrapcode_id = val.loc['Code Id']
-            _scrapcode_name = val.loc['Code']
-            _scrap_cost = val.loc['Cost']
-            _scrap_qty = val.loc['Scrap/Rework Qty']
-            
-            try:
-                if (self._filter_model(_so_pn) != None):
-                    self._add_scrap(_date, _so, _scrap_pn, _scrapcode_id, _scrap_qty, _scrap_cost, _plant)
-                    self._add_shoporder(_so, _so_pn, _so_desc, _so_qty, _status)
-                    self._add_component(_so_pn, _scrap_pn, _scrap_desc)
-            except:
-                self.errors.append(dict(df.iloc[index]))
-        
-        print(len(self.errors))
+    def run_rsl(self, csvfile, incremental = False, chunksize = None):
+        # chunksize streams the export: each chunk is filtered and written before the next is read, so memory
+        # stays flat however large the file is. The whole file is still one transaction.
+        self._create_rslloads_tables()
+        self._migrate_rsl_dates()
+        source = os.path.basename(csvfile)
+        if incremental and self._rsl_source_unchanged(csvfile, source):
+            print(f"{source}: unchanged since its last load, skipped")
+            return
+        
+        tl_pns = set(self._get_references()['models'])
+        existing = self._existing_rsl_keys()
+        if chunksize:
+            for df, rows_read in _read_rsl_chunks(csvfile, tl_pns, chunksize):
+                self._write_rsl(csvfile, df, rows_read, incremental, existing)
+        else:
+            df, rows_read = _read_rsl(csvfile, tl_pns)
+            self._write_rsl(csvfile, df, rows_read, incremental, existing)
+        self.references = None
+        
+        print(f"{source}: {len(self.errors)} RSL errors")
                 
         self.commit_changes()
-            
-    def _filter_model(self, material_num):
-        if (self.database and self.curr) != None:
-            material_num = int(material_num)
-            self.curr.execute("""SELECT tl_pn FROM LapFusionModels WHERE tl_pn = ?""", (material_num, ))
-            result = self.curr.fetchone()
-            if result:
-                return result[0]
-            else:
-                return None
-                
-    def _add_scrap(self, date, so, component_pn, scrap_code, scrap_qty, scrap_cost, plant):
-        if (self.database and self.curr) != None:
-            if math.isnan(scrap_qty):
-                scrap_qty = 0
-            self.curr.execute("""INSERT INTO RSL (date, so, component_pn, scrap_code, scrap_qty, cost, plant) VALUES (?, ?, ?, ?, ?, ?, ?)""", (date, so, component_pn, scrap_code, scrap_qty, scrap_cost, plant))
-                
-    def _add_shoporder(self, shoporder_num, tl_pn, description, qty, so_type):
-        if (self.database and self.curr) != None:
-            shoporder_num = int(shoporder_num)
-            self.curr.execute("""SELECT num FROM ShopOrders WHERE num = ?""", (shoporder_num, ))
-            result = self.curr.fetchone()
-            if result is None:
-                self.curr.execute("""INSERT INTO ShopOrders (num, tl_pn, description, so_qty, type) VALUES (?, ?, ?, ?, ?)""", (shoporder_num, tl_pn, description, qty, so_type))
-                self.curr.execute("""SELECT num FROM ShopOrders WHERE num =?""", (shoporder_num, ))
-                result = self.curr.fetchone()
+        
+    def run_rsl_parallel(self, csvfiles, workers = None, incremental = False):
+        # Workers parse and filter the files, this process is the only writer. Files are written in the
+        # order given (same as calling run_rsl on each), so the result never depends on which worker finishes first.
+        self._create_rslloads_tables()
+        self._migrate_rsl_dates()
+        if incremental:
+            csvfiles = [i for i in csvfiles if not self._rsl_source_unchanged(i, os.path.basename(i))]
+        if not csvfiles:
+            print("RSL files: all unchanged since their last load, skipped")
+            return
+        
+        tl_pns = set(self._get_references()['models'])
+        existing = self._existing_rsl_keys()
+        with ProcessPoolExecutor(max_workers = workers or min(len(csvfiles), os.cpu_count())) as pool:
+            futures = [pool.submit(_read_rsl, csvfile, tl_pns) for csvfile in csvfiles]
+            for csvfile, future in zip(csvfiles, futures):
+                df, rows_read = future.result()
+                self._write_rsl(csvfile, df, rows_read, incremental, existing)
+        self.references = None
                 
-    def _add_component(self, _so_pn, _scrap_pn, _scrap_desc):
-        if (self.database and self.curr) != None:
-            self.curr.execute("""SELECT component_pn, tl_pn FROM Components WHERE component_pn = ? AND tl_pn = ?""", (_scrap_pn, _so_pn, ))
-            result = self.curr.fetchone()
-            if result == None:
-                self.curr.execute("""INSERT INTO Components (component_pn, description, tl_pn) VALUES (?, ?, ?)""", (_scrap_pn, _scrap_desc, _so_pn))
-            else:
-                return result[0]
+        print(f"RSL files: {len(csvfiles)} loaded, {len(self.errors)} RSL errors")
+        
+        self.commit_changes()
+        
+    def _write_rsl(self, csvfile, df, rows_read, incremental, existing):
+        if incremental:
+            df = self._drop_loaded_rsl_rows(df)
+        loaded = self._bulk_insert_rsl(df, existing)
+        self._record_rsl_load(csvfile, os.path.basename(csvfile), df[loaded], rows_read)
+        self._mark_dirty(df.loc[loaded, 'Shop/Service Order #'])
+        
+    def _rsl_source_unchanged(self, csvfile, source):
+        stat = os.stat(csvfile)
+        self.curr.execute("""SELECT file_size, file_mtime FROM RSLLoads WHERE source = ?""", (source, ))
+        return self.curr.fetchone() == (stat.st_size, stat.st_mtime)
+    
+    def _drop_loaded_rsl_rows(self, df):
+        # Only the keys in this frame's RSL # range are looked up, so a chunk does not read the whole load history
+        rsl_nums = df['_rsl_num'].dropna()
+        rows = []
+        if len(rsl_nums):
+            self.curr.execute("""SELECT rsl_num, line FROM RSLKeys WHERE rsl_num BETWEEN ? AND ?""", (int(rsl_nums.min()), int(rsl_nums.max())))
+            rows = self.curr.fetchall()
+        loaded = pd.MultiIndex.from_tuples(rows, names = ['_rsl_num', '_line'])
+        unkeyed = df['_rsl_num'].isna()
+        self.errors.extend(df.loc[unkeyed].drop(columns = ['_rsl_num', '_line', '_is_model']).to_dict('records'))
+        seen = pd.MultiIndex.from_frame(df[['_rsl_num', '_line']].fillna(-1)).isin(loaded)
+        return df[~unkeyed & ~seen].reset_index(drop = True)
+    
+    def _record_rsl_load(self, csvfile, source, loaded, rows_read):
+        stat = os.stat(csvfile)
+        self.curr.execute(
+            """INSERT INTO RSLLoads (source, file_size, file_mtime, rows_read, rows_loaded, max_rsl_num, loaded_at) VALUES (?, ?, ?, ?, ?, ?, datetime('now'))
+            ON CONFLICT(source) DO UPDATE SET file_size = excluded.file_size, file_mtime = excluded.file_mtime, rows_read = excluded.rows_read,
+            rows_loaded = rows_loaded + excluded.rows_loaded, max_rsl_num = MAX(COALESCE(max_rsl_num, 0), COALESCE(excluded.max_rsl_num, 0)), loaded_at = excluded.loaded_at""",
+            (source, stat.st_size, stat.st_mtime, rows_read, len(loaded), None if loaded['_rsl_num'].isna().all() else int(loaded['_rsl_num'].max())))
+        keys = loaded.loc[loaded['_rsl_num'].notna(), ['_rsl_num', '_line']].assign(source = source)
+        self.curr.executemany("""INSERT OR REPLACE INTO RSLKeys (rsl_num, line, source) VALUES (?, ?, ?)""", _to_records(keys))
+        
+    def _existing_rsl_keys(self):
+        # ShopOrders and Components keys read once per load and kept up to date by _bulk_insert_rsl across files and chunks
+        self.curr.execute("""SELECT num FROM ShopOrders""")
+        shoporders = set([i[0] for i in self.curr.fetchall()])
+        self.curr.execute("""SELECT component_pn, tl_pn FROM Components""")
+        return {'shoporders': shoporders, 'components': set(self.curr.fetchall())}
+        
+    def _bulk_insert_rsl(self, df, existing):
+        # Reproduces the old per-row _filter_model -> _add_scrap -> _add_shoporder -> _add_component
+        # sequence with masks: a row that fails a stage is an error and skips the stages after it,
+        # but whatever it already inserted stays (same as the old try/except around each row).
+        existing_shoporders = existing['shoporders']
+        existing_components = existing['components']
+        
+        is_model = df['_is_model']
+        bad_pn = ~is_model
+        
+        # RSL stage
+        scrap_qty = df['Scrap/Rework Qty']
+        bad_qty = scrap_qty.notna() & pd.to_numeric(scrap_qty, errors = 'coerce').isna()
+        missing = df[['Date', 'Shop/Service Order #', 'Scrap/Rework P/N', 'Code Id', 'Plant']].isna().any(axis = 1)
+        dates = _parse_dates(df['Date'])
+        bad_date = df['Date'].notna() & dates.isna()
+        rsl_ok = is_model & ~bad_qty & ~missing & ~bad_date
+        
+        # ShopOrders stage, first row that inserts a shop order wins
+        so_num = pd.to_numeric(df['Shop/Service Order #'], errors = 'coerce')
+        bad_so = rsl_ok & (so_num.isna() | np.isinf(so_num))
+        so_stage = rsl_ok & ~bad_so
+        so_key = so_num.where(so_stage, 0).astype('int64')
+        so_inserts = so_stage & df['Shop Order Qty'].notna()
+        so_seen = pd.Series([i in existing_shoporders for i in so_key], index = df.index, dtype = bool) | (so_inserts.astype(int).groupby(so_key).cumsum() - so_inserts > 0)
+        so_ok = so_stage & (so_seen | so_inserts)
+        so_inserts = so_inserts & ~so_seen
+        
+        # Components stage, keyed on (component_pn, tl_pn) like the old existence SELECT
+        component_key = self._numeric_key(df['Scrap/Rework P/N'])
+        tl_key = self._numeric_key(df['Shop Order P/N'])
+        component_inserts = so_ok & df['Scrap/Rework P/N Desc'].notna()
+        component_groups = [component_key.where(so_ok, 0), tl_key.where(so_ok, 0)]
+        component_exists = pd.Series([i in existing_components for i in zip(component_key, tl_key)], index = df.index, dtype = bool)
+        component_seen = component_exists | (component_inserts.astype(int).groupby(component_groups).cumsum() - component_inserts > 0)
+        component_ok = so_ok & (component_seen | component_inserts)
+        component_inserts = component_inserts & ~component_seen
+        
+        rsl = df.loc[rsl_ok, ['Date', 'Shop/Service Order #', 'Scrap/Rework P/N', 'Code Id', 'Scrap/Rework Qty', 'Cost', 'Plant']]
+        rsl['Scrap/Rework Qty'] = pd.to_numeric(rsl['Scrap/Rework Qty'], errors = 'coerce').fillna(0)
+        rsl['Date'] = dates[rsl_ok].dt.strftime('%Y-%m-%d')
+        rsl['month'] = dates[rsl_ok].dt.strftime('%Y-%m')
+        self.curr.executemany("""INSERT INTO RSL (date, so, component_pn, scrap_code, scrap_qty, cost, plant, month) VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", _to_records(rsl))
+        
+        shoporders = df.loc[so_inserts, ['Shop/Service Order #', 'Shop Order P/N', 'Shop Order P/N Desc', 'Shop Order Qty', 'Status']]
+        shoporders['Shop/Service Order #'] = so_key[so_inserts]
+        shoporders['so_qty_raw'] = shoporders['Shop Order Qty']
+        self.curr.executemany("""INSERT INTO ShopOrders (num, tl_pn, description, so_qty, type, so_qty_raw) VALUES (?, ?, ?, ?, ?, ?)""", _to_records(shoporders))
+        
+        # first/last RSL date kept here rather than left to the update stage, so date filters see rows as soon as they load.
+        # A new shop order takes its span from RSL (its rows can predate it), the others are widened and only written if it grows.
+        self.curr.executemany("""UPDATE ShopOrders SET first_date = (SELECT MIN(date) FROM RSL WHERE RSL.so = ShopOrders.num AND RSL.month IS NOT NULL),
+            last_date = (SELECT MAX(date) FROM RSL WHERE RSL.so = ShopOrders.num AND RSL.month IS NOT NULL) WHERE num = ?""", _to_records(so_key[so_inserts].to_frame()))
+        dated = rsl_ok & so_stage
+        spans = dates[dated].groupby(so_key[dated]).agg(['min', 'max'])
+        spans = pd.DataFrame({'first': spans['min'].dt.strftime('%Y-%m-%d'), 'last': spans['max'].dt.strftime('%Y-%m-%d'), 'so': spans.index})
+        self.curr.executemany("""UPDATE ShopOrders SET first_date = MIN(COALESCE(first_date, ?), ?), last_date = MAX(COALESCE(last_date, ?), ?)
+            WHERE num = ? AND (first_date IS NULL OR first_date > ? OR last_date < ?)""", _to_records(spans[['first', 'first', 'last', 'last', 'so', 'first', 'last']]))
+        
+        components = df.loc[component_inserts, ['Scrap/Rework P/N', 'Scrap/Rework P/N Desc', 'Shop Order P/N']]
+        self.curr.executemany("""INSERT INTO Components (component_pn, description, tl_pn) VALUES (?, ?, ?)""", _to_records(components))
+        existing_shoporders.update(so_key[so_inserts].tolist())
+        existing_components.update(zip(component_key[component_inserts], tl_key[component_inserts]))
+        
+        errors = bad_pn | (is_model & ~rsl_ok) | bad_so | (so_stage & ~so_ok) | (so_ok & ~component_ok)
+        self.errors.extend(df[errors].drop(columns = ['_rsl_num', '_line', '_is_model']).to_dict('records'))
+        return rsl_ok
+        
+    def _numeric_key(self, column):
+        # Matches how sqlite compares a bound value against an INTEGER column
+        numbers = pd.to_numeric(column, errors = 'coerce')
+        return numbers.astype(object).where(numbers.notna(), column)
                 
                 
                 
                     
+    # DIRTY SHOP ORDER FUNCTIONS
+    def _create_dirty_table(self):
+        # Shop orders each stage still has to recompute. A database from before this table existed
+        # starts with every shop order dirty, so the first run after upgrading is a full one.
+        self.curr.execute("""SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'DirtyShopOrders'""")
+        if self.curr.fetchone():
+            return
+        self.curr.execute(
+            """
+            CREATE TABLE DirtyShopOrders (
+            num INTEGER(7) NOT NULL,
+            stage TEXT NOT NULL,
+            PRIMARY KEY (stage, num)
+            ) WITHOUT ROWID
+            """
+        )
+        self.curr.execute("""SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ShopOrders'""")
+        if self.curr.fetchone():
+            for stage in DIRTY_STAGES:
+                self.curr.execute("""INSERT INTO DirtyShopOrders (num, stage) SELECT num, ? FROM ShopOrders""", (stage, ))
+    
+    def _mark_dirty(self, shoporders, stages = DIRTY_STAGES):
+        self._create_dirty_table()
+        shoporders = pd.to_numeric(pd.Series(shoporders, dtype = object), errors = 'coerce')
+        shoporders = shoporders[np.isfinite(shoporders)].astype('int64').unique()
+        self.curr.executemany("""INSERT OR IGNORE INTO DirtyShopOrders (num, stage) VALUES (?, ?)""",
+                              [(int(num), stage) for stage in stages for num in shoporders])
+    
+    def _dirty_filter(self, stage, shoporders = None, full = False):
+        # SQL predicate (with a {shoporder} placeholder for the column) and params selecting what a stage recomputes
+        self._create_dirty_table()
+        if full:
+            return """1""", []
+        if shoporders is not None:
+            self._mark_dirty(shoporders, [stage])
+        return """{shoporder} IN (SELECT num FROM DirtyShopOrders WHERE stage = ?)""", [stage]
+    
+    def _clear_dirty(self, stage, full = False, next_stage = None):
+        # What a stage recomputed is dirty for the stage that reads its output
+        if next_stage:
+            if full:
+                self.curr.execute("""INSERT OR IGNORE INTO DirtyShopOrders (num, stage) SELECT num, ? FROM ShopOrders""", (next_stage, ))
+            else:
+                self.curr.execute("""INSERT OR IGNORE INTO DirtyShopOrders (num, stage) SELECT num, ? FROM DirtyShopOrders WHERE stage = ?""", (next_stage, stage))
+        self.curr.execute("""DELETE FROM DirtyShopOrders WHERE stage = ?""", (stage, ))
+    
     # SCRAP FUNCTIONS 
-    def main_scrap_function(self):
+    def main_scrap_function(self, shoporders = None, full = False):
+        # Only the shop orders run_rsl marked dirty (plus any passed in) are recomputed, full = True rebuilds every one
         if (self.database and self.curr) != None:
+            self._migrate_so_qty_raw()
             self._create_scraplog_tables()
-            self._update_scraplog_columns()
-            self._add_scraplog_shoporders()
-            self._input_scraplog_data()
+            self._input_scraplog_data(self._dirty_filter('scrap', shoporders, full))
+            self._create_log_view('QCScrapLog', 'QCScrap')
+            self._create_log_view('ProdScrapLog', 'ProdScrap')
+            self._clear_dirty('scrap', full, next_stage = 'update')
+            self.refresh_summary(shoporders, full)
+            self.commit_changes()
             
             # self._get_fulldevice_scrap(shoporder)
             
     def _create_scraplog_tables(self):
+        self._drop_legacy_log('QCScrapLog')
+        self._drop_legacy_log('ProdScrapLog')
+        self._create_scrapfacts_table()
+        
+    def _create_scrapfacts_table(self):
+        # One row per (shop order, log, plant, code) that actually has scrap or rework. QCScrapLog, ProdScrapLog
+        # and ProdReworkLog are pivot views over this table (see _create_log_view).
         self.curr.execute(
             """
-            CREATE TABLE IF NOT EXISTS QCScrapLog (
-            shoporder INTEGER(7) PRIMARY KEY NOT NULL,
-            FOREIGN KEY (shoporder) REFERENCES ShopOrders(num)
-            )
+            CREATE TABLE IF NOT EXISTS ScrapFacts (
+            shoporder INTEGER(7) NOT NULL,
+            plant TEXT NOT NULL,
+            log_type TEXT NOT NULL,
+            code_id INTEGER(3) NOT NULL,
+            qty NUMERIC NOT NULL,
+            cost REAL DEFAULT 0 NOT NULL,
+            PRIMARY KEY (shoporder, log_type, plant, code_id),
+            FOREIGN KEY (shoporder) REFERENCES ShopOrders(num),
+            FOREIGN KEY (code_id) REFERENCES ScrapCodes(id)
+            ) WITHOUT ROWID
             """
         )
+        self._add_missing_columns('ScrapFacts', {'cost': 'REAL DEFAULT 0 NOT NULL'})
+        self.curr.execute("""CREATE INDEX IF NOT EXISTS ScrapFacts_log_code ON ScrapFacts (log_type, code_id, shoporder, qty)""")
+        
+    def _add_missing_columns(self, table, columns):
+        # CREATE TABLE IF NOT EXISTS leaves tables from older databases alone, so new columns are added here
+        self.curr.execute(f"""PRAGMA table_info({table})""")
+        existing = set([i[1] for i in self.curr.fetchall()])
+        for column, definition in columns.items():
+            if column not in existing:
+                self.curr.execute(f"""ALTER TABLE {table} ADD COLUMN {column} {definition}""")
         
+    def _drop_legacy_log(self, name):
+        # Logs used to be wide tables with one ALTER TABLE column per scrap code
+        self.curr.execute("""SELECT type FROM sqlite_master WHERE name = ?""", (name, ))
+        result = self.curr.fetchone()
+        if result and result[0] == 'table':
+            self.curr.execute(f"""DROP TABLE {name}""")
+        
+    def _input_scraplog_data(self, dirty):
+        # Full device scrap only (component_pn = tl_pn). DM1 rows go to ProdScrapLog and QC-DM1 rows to QCScrapLog,
+        # rows sharing a code are summed. Codes missing from ScrapCodes are left out, like the old inner join.
+        # dirty is the (predicate on {shoporder}, params) pair from _dirty_filter
+        predicate, params = dirty
+        self.curr.execute(f"""DELETE FROM ScrapFacts WHERE log_type IN ('QCScrap', 'ProdScrap') AND {predicate.format(shoporder = 'shoporder')}""", params)
         self.curr.execute(
-            """
-            CREATE TABLE IF NOT EXISTS ProdScrapLog (
-            shoporder INTEGER (7) PRIMARY KEY NOT NULL, 
-            FOREIGN KEY (shoporder) REFERENCES ShopOrders(num)
-            )
-            """
-        )
-    
-    def _update_scraplog_columns(self):
-        self.curr.execute("""SELECT name FROM ScrapCodes""")
-        scrapcodes = set([i[0] for i in self.curr.fetchall()])
+            f"""
+            INSERT INTO ScrapFacts (shoporder, plant, log_type, code_id, qty, cost)
+            SELECT RSL.so, RSL.plant, CASE RSL.plant WHEN 'DM1' THEN 'ProdScrap' ELSE 'QCScrap' END, RSL.scrap_code, SUM(RSL.scrap_qty), TOTAL(RSL.cost)
+            FROM RSL
+            INNER JOIN ShopOrders ON ShopOrders.num = RSL.so AND ShopOrders.tl_pn = RSL.component_pn
+            WHERE RSL.plant IN ('DM1', 'QC-DM1') AND RSL.scrap_code IN (SELECT id FROM ScrapCodes) AND {predicate.format(shoporder = 'RSL.so')}
+            GROUP BY RSL.so, RSL.plant, RSL.scrap_code
+            """, params)
         
-        for i in sorted(scrapcodes):
-            self.curr.execute(f"""ALTER TABLE QCScrapLog ADD COLUMN '{i}' INTEGER DEFAULT 0 NOT NULL""")
-            self.curr.execute(f"""ALTER TABLE ProdScrapLog ADD COLUMN '{i}' INTEGER DEFAULT 0 NOT NULL""")
-        self.commit_changes()
+    def _create_log_view(self, view, log_type):
+        # Rebuilds the old wide log shape on demand: every shop order, one column per scrap code name.
+        # Code ids are grouped by name since a name can have several ids, each id counts under its SCRAP_CODE_NAMES name only.
+        self.curr.execute(f"""SELECT name, id FROM ({SCRAP_CODE_NAMES}) ORDER BY name""")
+        codes = {}
+        for name, code_id in self.curr.fetchall():
+            codes.setdefault(name, set()).add(int(code_id))
+        pivots = ',\n'.join(f"""SUM(CASE WHEN ScrapFacts.code_id IN ({', '.join(str(i) for i in sorted(ids))}) THEN ScrapFacts.qty ELSE 0 END) AS {_quote_identifier(name)}""" for name, ids in codes.items())
         
-    def _add_scraplog_shoporders(self):
-        self.curr.execute("""SELECT num, tl_pn FROM ShopOrders""") # Creates a list of the Shop Orders in the ShopOrder Table
-        for shoporder, tl_pn in self.curr.fetchall(): # Checks each Shop Order from the list to see if they exist in the ScrapLog Table
-            self.curr.execute("""SELECT shoporder FROM QCScrapLog WHERE shoporder = ?""", (shoporder, ))
-            # print(f"\n******************************\n     SHOP ORDER {shoporder}\n******************************")
-            if self.curr.fetchone() == None: # Adds Shop Order from the list to the ScrapLog Table
-                # print(f"***** Adding {shoporder} to QCScrapLog *****")
-                self.curr.execute("""INSERT INTO QCScrapLog (shoporder) VALUES (?)""", (shoporder, ))
-                
-            self.curr.execute("""SELECT shoporder FROM ProdScrapLog WHERE shoporder = ?""", (shoporder, ))
-            if self.curr.fetchone() == None:
-                self.curr.execute("""INSERT INTO ProdScrapLog (shoporder) VALUES (?)""", (shoporder, ))
-
-        self.database.commit()
-        
-    def _input_scraplog_data(self):
-        self.curr.execute("""SELECT num, tl_pn FROM ShopOrders""")
-        for shoporder, tl_pn in self.curr.fetchall():
-            self.curr.execute("""SELECT so, name, scrap_code, scrap_qty, RSL.plant FROM RSL INNER JOIN ScrapCodes ON RSL.scrap_code = ScrapCodes.id WHERE so = ? AND component_pn = ?""", (shoporder, tl_pn))
-            for so, name, scrap_code, scrap_qty, plant in self.curr.fetchall(): # Gets all full device scrap from RSL per Shop Order
-                if plant == 'DM1':
-                    self.curr.execute(f"""UPDATE ProdScrapLog SET '{name}' = ? WHERE shoporder = ?""", (scrap_qty, shoporder))
-                elif plant == 'QC-DM1':
-                    self.curr.execute(f"""UPDATE QCScrapLog SET '{name}' = ? WHERE shoporder = ?""", (scrap_qty, shoporder))
-        self.database.commit()
+        self.curr.execute(f"""DROP VIEW IF EXISTS {view}""")
+        self.curr.execute(
+            f"""
+            CREATE VIEW {view} AS
+            SELECT ShopOrders.num AS shoporder,
+            {pivots}
+            FROM ShopOrders
+            LEFT JOIN ScrapFacts ON ScrapFacts.shoporder = ShopOrders.num AND ScrapFacts.log_type = '{log_type}'
+            GROUP BY ShopOrders.num
+            """
+        )
             
             
             
@@ -384,124 +1184,149 @@ class RSLManager:
             
             
     # REWORK FUNCTIONS
-    def main_rework_function(self):
+    def main_rework_function(self, shoporders = None, full = False):
         if (self.database and self.curr) != None:
+            self._migrate_so_qty_raw()
             self._create_reworklog_tables()
-            self._update_reworklog_columnns()
-            self._add_reworklog_shoporders()
-            self._input_reworklog_data()
+            self._input_reworklog_data(self._dirty_filter('rework', shoporders, full))
+            self._create_log_view('ProdReworkLog', 'ProdRework')
+            self._clear_dirty('rework', full, next_stage = 'update')
+            self.commit_changes()
         
     def _create_reworklog_tables(self):
-        self.curr.execute(
-            """
-            CREATE TABLE IF NOT EXISTS ProdReworkLog(
-            shoporder INTEGER(7) PRIMARY KEY NOT NULL, 
-            FOREIGN KEY (shoporder) REFERENCES ShopOrders(num)
-            )
-            """
-        )
-        
-    def _update_reworklog_columnns(self):
-        self.curr.execute("""SELECT name FROM ScrapCodes""")
-        scrapcodes = set([i[0] for i in self.curr.fetchall()])
-        
-        for i in sorted(scrapcodes):
-            self.curr.execute(f"""ALTER TABLE ProdReworkLog ADD COLUMN '{i}' INTEGER DEFAULT 0 NOT NULL""")
-        self.commit_changes()
+        self._drop_legacy_log('ProdReworkLog')
+        self._create_scrapfacts_table()
         
-    def _add_reworklog_shoporders(self):
-        self.curr.execute("""SELECT num, tl_pn FROM ShopOrders""")
-        for shoporder, tl_pn in self.curr.fetchall():
-            self.curr.execute("""SELECT shoporder FROM ProdReworkLog WHERE shoporder = ?""", (shoporder, ))
-            if self.curr.fetchone() == None:
-                self.curr.execute("""INSERT INTO ProdReworkLog (shoporder) VALUES (?)""", (shoporder, ))
-        self.database.commit()
-        
-    def _input_reworklog_data(self):
-        self.curr.execute("""SELECT component_pn FROM Components WHERE description = ?""", ('HUB, 5MM FUSION', ))
-        hub_pns = [i[0] for i in self.curr.fetchall()]
-        
-        self.curr.execute("""SELECT num, tl_pn FROM ShopOrders""")
-        for shoporder, tl_pn in self.curr.fetchall():
-            self.curr.execute("""SELECT so, component_pn, name, scrap_code, scrap_qty, RSL.plant FROM RSL INNER JOIN ScrapCodes on RSL.scrap_code = ScrapCodes.id WHERE so = ? AND component_pn != ?""", (shoporder, tl_pn))
-            for so, component_pn, name, scrap_code, scrap_qty, plant in self.curr.fetchall():
-                self.curr.execute("""SELECT description FROM Components WHERE component_pn = ? AND tl_pn = ?""", (component_pn, tl_pn))
-                component_name = self.curr.fetchone()[0]
-                if component_pn in hub_pns:
-                    if name in ['Material Overissue', 'Material Underissue', 'Fixed Quantity', 'Defective Components']:
-                        continue
-                    else:
-                        self.curr.execute(f"""UPDATE ProdReworkLog SET '{name}' = ? WHERE shoporder = ?""", (scrap_qty/2, so))
-            self.database.commit()
-            
-
-
+    def _input_reworklog_data(self, dirty):
+        # Component rework (component_pn != tl_pn) on hub components, outside the excluded codes, at half quantity.
+        # A component is a hub if any of its Components rows has a hub description. Codes missing from ScrapCodes are left
+        # out and exclusions match the SCRAP_CODE_NAMES name, as in _classify_rsl.
+        hubs = ', '.join(['?'] * len(self.hub_descriptions))
+        excluded = ', '.join(['?'] * len(self.rework_excluded_codes))
+        predicate, params = dirty
+        self.curr.execute(f"""DELETE FROM ScrapFacts WHERE log_type = 'ProdRework' AND {predicate.format(shoporder = 'shoporder')}""", params)
+        self.curr.execute(
+            f"""
+            INSERT INTO ScrapFacts (shoporder, plant, log_type, code_id, qty, cost)
+            SELECT RSL.so, RSL.plant, 'ProdRework', RSL.scrap_code, SUM(RSL.scrap_qty / 2.0), TOTAL(RSL.cost)
+            FROM RSL
+            INNER JOIN ShopOrders ON ShopOrders.num = RSL.so
+            WHERE RSL.component_pn != ShopOrders.tl_pn
+            AND RSL.component_pn IN (SELECT component_pn FROM Components WHERE description IN ({hubs}))
+            AND EXISTS (SELECT 1 FROM ScrapCodes WHERE ScrapCodes.id = RSL.scrap_code)
+            AND RSL.scrap_code NOT IN (SELECT id FROM ({SCRAP_CODE_NAMES}) WHERE name IN ({excluded}))
+            AND {predicate.format(shoporder = 'RSL.so')}
+            GROUP BY RSL.so, RSL.plant, RSL.scrap_code
+            """, self.hub_descriptions + self.rework_excluded_codes + params)
     
                 
     # UPDATE FUNCTIONS
-    def main_update_function(self):
+    def main_update_function(self, shoporders = None, full = False):
+        # so_qty, scrap/rework totals and costs for the dirty shop orders (every one with full = True) in one statement.
+        # so_qty is always recomputed from so_qty_raw (the RSL Shop Order Qty), so running the stage again changes nothing.
         if (self.database and self.curr) != None:
-            self._convert_so_qty()
-            self._update_scrap_qty()
-            self._update_rework_qty()
-            
-    def _convert_so_qty(self):
-        self.curr.execute("""SELECT num FROM ShopOrders""")
-        shoporders = [i[0] for i in self.curr.fetchall()]
-        for shoporder in shoporders:
-            self.curr.execute("""SELECT so_qty FROM ShopOrders WHERE num = ?""", (shoporder, ))
-            so_qty = self.curr.fetchone()[0] * 6
-            self.curr.execute("""UPDATE ShopOrders SET so_qty = ? WHERE num = ?""", (so_qty, shoporder))
-        self.commit_changes()
-            
-    def _update_scrap_qty(self):
-        self.curr.execute("""SELECT num FROM ShopOrders""")
-        shoporders = [i[0] for i in self.curr.fetchall()]
-        for shoporder in shoporders:
-            self.curr.execute("""SELECT * FROM ProdScrapLog WHERE shoporder = ?""", (shoporder, ))
-            prod_scrap_list = [i[1:len(i)] for i in self.curr.fetchall()]
-            prod_scrap_list = list(prod_scrap_list[0])
-            
-            self.curr.execute("""SELECT * FROM QCScrapLog WHERE shoporder = ?""", (shoporder, ))
-            qc_scrap_list = [i[1:len(i)] for i in self.curr.fetchall()]
-            qc_scrap_list = list(qc_scrap_list[0])
-            
-            total_scrap = 0
-            for scrap in qc_scrap_list:
-                total_scrap = total_scrap + scrap
-                
-            for scrap in prod_scrap_list:
-                total_scrap = total_scrap + scrap
-                
-            self.curr.execute("""UPDATE ShopOrders SET scrap_qty = ? WHERE num = ?""", (total_scrap, shoporder))
-        
-        self.commit_changes()    
-        
-    def _update_rework_qty(self):
-        self.curr.execute("""SELECT num FROM ShopOrders""")
-        shoporders = [i[0] for i in self.curr.fetchall()]
-        for shoporder in shoporders:
-            self.curr.execute("""SELECT * FROM ProdReworkLog WHERE shoporder = ?""", (shoporder, ))
-            prod_rework_list = [i[1:len(i)] for i in self.curr.fetchall()]
-            prod_rework_list = list(prod_rework_list[0])
-            
-            total_rework = 0
-            for rework in prod_rework_list:
-                total_rework = total_rework + rework
-                
-            self.curr.execute("""UPDATE ShopOrders SET rework_qty = ? WHERE num = ?""", (total_rework, shoporder))
-        
-        self.commit_changes()
+            predicate, params = self._dirty_filter('update', shoporders, full)
+            self._add_missing_columns('ShopOrders', {'scrap_cost': 'REAL DEFAULT 0 NOT NULL', 'rework_cost': 'REAL DEFAULT 0 NOT NULL'})
+            self._migrate_rsl_dates()
+            self._migrate_so_qty_raw()
+            self.curr.execute(
+                f"""
+                UPDATE ShopOrders SET
+                so_qty = ShopOrders.so_qty_raw * {SO_QTY_MULTIPLIER},
+                scrap_qty = totals.scrap_qty,
+                rework_qty = totals.rework_qty,
+                scrap_cost = totals.scrap_cost,
+                rework_cost = totals.rework_cost,
+                first_date = (SELECT MIN(date) FROM RSL WHERE RSL.so = ShopOrders.num AND RSL.month IS NOT NULL),
+                last_date = (SELECT MAX(date) FROM RSL WHERE RSL.so = ShopOrders.num AND RSL.month IS NOT NULL)
+                FROM (
+                    SELECT ShopOrders.num,
+                    COALESCE(SUM(CASE WHEN ScrapFacts.log_type IN ('QCScrap', 'ProdScrap') THEN ScrapFacts.qty END), 0) AS scrap_qty,
+                    COALESCE(SUM(CASE WHEN ScrapFacts.log_type = 'ProdRework' THEN ScrapFacts.qty END), 0) AS rework_qty,
+                    TOTAL(CASE WHEN ScrapFacts.log_type IN ('QCScrap', 'ProdScrap') THEN ScrapFacts.cost END) AS scrap_cost,
+                    TOTAL(CASE WHEN ScrapFacts.log_type = 'ProdRework' THEN ScrapFacts.cost END) AS rework_cost
+                    FROM ShopOrders
+                    LEFT JOIN ScrapFacts ON ScrapFacts.shoporder = ShopOrders.num
+                    WHERE {predicate.format(shoporder = 'ShopOrders.num')}
+                    GROUP BY ShopOrders.num
+                ) AS totals
+                WHERE totals.num = ShopOrders.num
+                """, params)
+            self._clear_dirty('update', full)
+            self.refresh_summary(shoporders, full)
+            self.commit_changes()
                 
         
 
 
 
 
+    def _migrate_so_qty_raw(self):
+        # ShopOrders rows loaded before so_qty_raw existed only have so_qty, which the old update stage multiplied in place.
+        # Only nonzero scrap/rework totals, which the old update stage wrote in the same pass, prove it was converted; then it
+        # is divided back. Anything else (scrap/rework run but not update, or nothing scrapped) cannot be told apart, so the database has to be reloaded.
+        self._add_missing_columns('ShopOrders', {'so_qty_raw': 'INTEGER'})
+        self.curr.execute("""SELECT COUNT(*), TOTAL(scrap_qty != 0 OR rework_qty != 0), TOTAL(so_qty % ? != 0) FROM ShopOrders WHERE so_qty_raw IS NULL""", (SO_QTY_MULTIPLIER, ))
+        legacy, updated, indivisible = self.curr.fetchone()
+        if not legacy:
+            return
+        if updated and not indivisible:
+            self.curr.execute("""UPDATE ShopOrders SET so_qty_raw = so_qty / ? WHERE so_qty_raw IS NULL""", (SO_QTY_MULTIPLIER, ))
+            return
+        raise RuntimeError(f"{legacy} ShopOrders rows were loaded before so_qty_raw existed and it is not clear whether the old update stage already "
+                           f"multiplied their so_qty by {SO_QTY_MULTIPLIER}. Rebuild the database: python main.py --rebuild --stages create load scrap rework update")
+        
     # ANALYSIS FUNCTIONS
-    def main_analysis_function(self):
+    def main_analysis_function(self, models = None, show = True):
+        # Computes SPC for every model, charts are only drawn for the models asked for
         if (self.database and self.curr) != None:
-            self._generate_yield_chart()
+            spc = self.compute_yield_spc()
+            spc['violations'] = self.evaluate_spc_rules(spc = spc)
+            for model in models or []:
+                self._generate_yield_chart(model, spc, show)
+            return spc
+            
+    def compute_yield_spc(self, models = None, window = None, so_type = 'Production', start_date = None, end_date = None):
+        # Headless yield/SPC for all models in one pass. Returns {'points': one row per shop order with its yield and the
+        # center line/control limits that apply to it, 'limits': one row per model}. With window = N the limits on each
+        # point come from the trailing N shop orders of that model instead of the model's whole history.
+        # start_date/end_date keep the shop orders whose first RSL activity falls in the range.
+        filters = ["""ShopOrders.type = ?"""]
+        params = [so_type]
+        if start_date is not None:
+            filters.append("""ShopOrders.first_date >= ?""")
+            params.append(pd.Timestamp(start_date).strftime('%Y-%m-%d'))
+        if end_date is not None:
+            filters.append("""ShopOrders.first_date <= ?""")
+            params.append(pd.Timestamp(end_date).strftime('%Y-%m-%d'))
+        df = self._read_sql(
+            f"""
+            SELECT LapFusionModels.model, num, so_qty, scrap_qty
+            FROM ShopOrders
+            JOIN LapFusionModels ON LapFusionModels.tl_pn = ShopOrders.tl_pn
+            WHERE {' AND '.join(filters)}
+            ORDER BY LapFusionModels.model, num ASC
+            """, params)
+        if models is not None:
+            df = df[df['model'].isin(models)]
+        df = df[df['so_qty'] != 0].reset_index(drop = True)
+        df['yield'] = ((df['scrap_qty'] - df['so_qty']) / df['so_qty'] * 100).abs().round(2)
+        
+        grouped = df.groupby('model', sort = False)['yield']
+        limits = pd.DataFrame({'shoporders': grouped.size(), 'center': grouped.mean().round(2), 'std': grouped.std(ddof = 0).round(4)})
+        limits['ucl'] = limits['center'] + 3 * limits['std']
+        limits['lcl'] = limits['center'] - 3 * limits['std']
+        
+        if window:
+            rolling = grouped.rolling(window, min_periods = 2)
+            df['center'] = rolling.mean().round(2).reset_index(level = 0, drop = True)
+            df['std'] = rolling.std(ddof = 0).round(4).reset_index(level = 0, drop = True)
+        else:
+            df = df.join(limits[['center', 'std']], on = 'model')
+        df['ucl'] = df['center'] + 3 * df['std']
+        df['lcl'] = df['center'] - 3 * df['std']
+        
+        return {'points': df, 'limits': limits.reset_index()}
         
     # def _generate_yield_chart(self, model):
     #     self.curr.execute("""SELECT num, so_qty, scrap_qty FROM ShopOrders JOIN LapFusionModels ON LapFusionModels.tl_pn = ShopOrders.tl_pn WHERE LapFusionModels.model = ? AND ShopOrders.type = ? ORDER BY num ASC""", (model, 'Production'))
@@ -528,30 +1353,185 @@ class RSLManager:
     #     plt.show()
     
     
-    def _generate_yield_chart(self, model):
-        self.curr.execute("""
-            SELECT num, so_qty, scrap_qty
-            FROM ShopOrders
-            JOIN LapFusionModels ON LapFusionModels.tl_pn = ShopOrders.tl_pn
-            WHERE LapFusionModels.model = ? AND ShopOrders.type = ?
-            ORDER BY num ASC
-        """, (model, 'Production'))
+    def _create_spc_tables(self):
+        self.curr.execute(
+            """
+            CREATE TABLE IF NOT EXISTS SPCLimits (
+            model VARCHAR(5) PRIMARY KEY NOT NULL,
+            center REAL NOT NULL,
+            sigma REAL NOT NULL,
+            shoporders INTEGER NOT NULL,
+            last_num INTEGER(7) NOT NULL
+            )
+            """
+        )
         
-        so_list = [i for i in self.curr.fetchall()]
-
-        yield_list = []
-        for so in so_list:
-            yield_list.append([so[0], so[1], so[1] - so[2], abs(round(((so[2] - so[1])/so[1])*100, 2))])
-
-        yield_percents = [i[3] for i in yield_list]
-
-        u = round(np.average(yield_percents), 2)
-        yield_std = round(np.std(yield_percents), 4)
-        yield_ucl = u + 3 * yield_std
-        yield_lcl = u - 3 * yield_std
+        self.curr.execute(
+            """
+            CREATE TABLE IF NOT EXISTS SPCViolations (
+            model VARCHAR(5) NOT NULL,
+            num INTEGER(7) NOT NULL,
+            rule TEXT NOT NULL,
+            yield REAL NOT NULL,
+            PRIMARY KEY (model, num, rule),
+            FOREIGN KEY (num) REFERENCES ShopOrders(num)
+            )
+            """
+        )
+        
+        self.curr.execute(
+            """
+            CREATE TABLE IF NOT EXISTS SPCPoints (
+            model VARCHAR(5) NOT NULL,
+            num INTEGER(7) NOT NULL,
+            yield REAL NOT NULL,
+            PRIMARY KEY (model, num),
+            FOREIGN KEY (num) REFERENCES ShopOrders(num)
+            )
+            """
+        )
+        
+    def evaluate_spc_rules(self, models = None, full = False, spc = None):
+        # Western Electric / Nelson rules on each model's yield series (shop orders in num order). The first run for a model
+        # (or full = True) freezes its center/sigma in SPCLimits and evaluates the whole history. SPCPoints keeps the yield each
+        # shop order was last evaluated at, later runs only re-evaluate the shop orders whose yield changed (or that are new)
+        # and the 7 after each of them, since the longest rule (8 in a row) looks back 7 points. Returns the violations found in this run.
+        self._create_spc_tables()
+        if spc is None:
+            spc = self.compute_yield_spc(models)
+        points = spc['points'][['model', 'num', 'yield']]
+        if models is not None:
+            points = points[points['model'].isin(models)]
+        points = points.reset_index(drop = True)
+        limits = spc['limits'].set_index('model')
+        
+        self.curr.execute("""SELECT model, center, sigma FROM SPCLimits""")
+        frozen = pd.DataFrame(self.curr.fetchall(), columns = ['model', 'center', 'sigma']).set_index('model')
+        if full:
+            frozen = frozen.iloc[0:0]
+        new_models = limits.index.difference(frozen.index)
+        reset = list(limits.index) if full else list(new_models)
+        baseline = limits.loc[new_models, ['center', 'std']].rename(columns = {'std': 'sigma'})
+        frozen = baseline if frozen.empty else pd.concat([frozen, baseline])
+        
+        self.curr.execute("""SELECT model, num, yield FROM SPCPoints""")
+        stored = pd.DataFrame(self.curr.fetchall(), columns = ['model', 'num', 'stored'])
+        if models is not None:
+            stored = stored[stored['model'].isin(models)]
+        stored = stored[~stored['model'].isin(reset)]
+        points = points.merge(stored, on = ['model', 'num'], how = 'left')
+        changed = points['stored'].isna() | (points['yield'] != points['stored'])
+        
+        # a shop order that dropped out of the series (so_qty 0, type changed) shifts the windows of the ones after it
+        removed = stored[~stored.set_index(['model', 'num']).index.isin(points.set_index(['model', 'num']).index)]
+        for model, num in removed[['model', 'num']].itertuples(index = False):
+            after = (points['model'] == model) & (points['num'] > num)
+            if after.any():
+                changed[after.idxmax()] = True
+        
+        by_model = changed.groupby(points['model'])
+        target = pd.concat([by_model.shift(i, fill_value = False) for i in range(8)], axis = 1).any(axis = 1)
+        by_model = target.groupby(points['model'])
+        window = pd.concat([by_model.shift(-i, fill_value = False) for i in range(8)], axis = 1).any(axis = 1)
+        
+        evaluated = points[window].drop(columns = 'stored').join(frozen, on = 'model', how = 'inner').reset_index(drop = True)
+        violations = self._spc_rule_violations(evaluated)
+        violations = violations[violations['num'].isin(points.loc[target, 'num'])][['model', 'num', 'rule', 'yield']]
+        
+        if reset:
+            self.curr.executemany("""DELETE FROM SPCViolations WHERE model = ?""", [(i, ) for i in reset])
+            self.curr.executemany("""DELETE FROM SPCPoints WHERE model = ?""", [(i, ) for i in reset])
+            self.curr.executemany("""INSERT OR REPLACE INTO SPCLimits (model, center, sigma, shoporders, last_num) VALUES (?, ?, ?, ?, 0)""",
+                                  _to_records(limits.loc[reset, ['center', 'std', 'shoporders']].reset_index()))
+        stale = pd.concat([points.loc[target, ['model', 'num']], removed[['model', 'num']]])
+        self.curr.executemany("""DELETE FROM SPCViolations WHERE model = ? AND num = ?""", _to_records(stale))
+        self.curr.executemany("""DELETE FROM SPCPoints WHERE model = ? AND num = ?""", _to_records(removed[['model', 'num']]))
+        self.curr.executemany("""INSERT OR REPLACE INTO SPCViolations (model, num, rule, yield) VALUES (?, ?, ?, ?)""", _to_records(violations))
+        self.curr.executemany("""INSERT OR REPLACE INTO SPCPoints (model, num, yield) VALUES (?, ?, ?)""", _to_records(points.loc[changed, ['model', 'num', 'yield']]))
+        self.curr.executemany("""UPDATE SPCLimits SET last_num = ? WHERE model = ?""", _to_records(points.groupby('model')['num'].max().reset_index()[['num', 'model']]))
+        self.commit_changes()
+        return violations.reset_index(drop = True)
+        
+    def _spc_rule_flags(self, points):
+        # One boolean column per rule, a point is flagged when the window ending on it breaks the rule
+        z = (points['yield'] - points['center']) / points['sigma'].replace(0, np.nan)
+        step = points.groupby('model')['yield'].diff()
+        
+        def count(condition, n):
+            return condition.astype(int).groupby(points['model']).rolling(n).sum().reset_index(level = 0, drop = True)
+        
+        return pd.DataFrame({
+            'beyond 3 sigma': z.abs() > 3,
+            '2 of 3 beyond 2 sigma': (count(z > 2, 3) >= 2) | (count(z < -2, 3) >= 2),
+            '4 of 5 beyond 1 sigma': (count(z > 1, 5) >= 4) | (count(z < -1, 5) >= 4),
+            '8 in a row on one side': (count(z > 0, 8) == 8) | (count(z < 0, 8) == 8),
+            '6 in a row trending': (count(step > 0, 5) == 5) | (count(step < 0, 5) == 5),
+        })
+    
+    def _spc_rule_violations(self, points):
+        flags = self._spc_rule_flags(points)
+        violations = points.join(flags).melt(id_vars = list(points.columns), var_name = 'rule', value_name = 'flagged')
+        return violations[violations['flagged']].drop(columns = 'flagged').sort_values(['model', 'num', 'rule'])
+        
+    def render_charts(self, models = None, out_dir = None, file_format = 'png', workers = None, top = 20):
+        # Headless batch rendering of the yield, scrap Pareto and rework Pareto charts for every model (file_format png,
+        # svg or html). Each model's chart data is hashed into out_dir/chart_cache.json, models whose data is unchanged and
+        # whose chart files are all still there (and not empty) are skipped.
+        out_dir = out_dir or os.path.join(os.getcwd(), 'results', 'charts')
+        os.makedirs(out_dir, exist_ok = True)
+        cache_path = os.path.join(out_dir, 'chart_cache.json')
+        cache = {}
+        if os.path.exists(cache_path):
+            with open(cache_path) as cache_file:
+                cache = json.load(cache_file)
+        
+        points = self.compute_yield_spc(models)['points']
+        counts = self._read_sql(
+            f"""
+            SELECT LapFusionModels.model, ScrapFacts.log_type, codes.name, SUM(ScrapFacts.qty) AS qty
+            FROM ScrapFacts
+            INNER JOIN ShopOrders ON ShopOrders.num = ScrapFacts.shoporder
+            INNER JOIN LapFusionModels ON LapFusionModels.tl_pn = ShopOrders.tl_pn
+            INNER JOIN ({SCRAP_CODE_NAMES}) AS codes ON codes.id = ScrapFacts.code_id
+            GROUP BY LapFusionModels.model, ScrapFacts.log_type, codes.name
+            """)
+        counts['log'] = np.where(counts['log_type'] == 'ProdRework', 'rework', 'scrap')
+        counts = counts.groupby(['model', 'log', 'name'])['qty'].sum()
+        
+        jobs = []
+        for model in models or sorted(set(self._get_references()['models'].values())):
+            model_points = points.loc[points['model'] == model, ['num', 'yield', 'center', 'ucl', 'lcl']].reset_index(drop = True)
+            paretos = []
+            for log in ['scrap', 'rework']:
+                pareto = counts.loc[(model, log)] if (model, log) in counts.index.droplevel(2) else pd.Series(dtype = float)
+                pareto = pareto[pareto > 0].sort_values(ascending = False, kind = 'stable').to_frame('qty')
+                pareto['cumulative'] = pareto['qty'].cumsum() / pareto['qty'].sum() * 100
+                paretos.append(pareto.head(top))
+            digest = hashlib.sha1(f"{model_points.to_csv()}|{paretos[0].to_csv()}|{paretos[1].to_csv()}".encode()).hexdigest()
+            rendered = all(os.path.exists(i) and os.path.getsize(i) > 0 for i in _chart_paths(model, out_dir, file_format))
+            if cache.get(f"{model}.{file_format}") != digest or not rendered:
+                jobs.append((model, model_points, paretos[0], paretos[1], digest))
+        
+        if workers != 0 and len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers = workers) as pool:
+                futures = [pool.submit(_render_model_charts, model, model_points, scrap, rework, out_dir, file_format) for model, model_points, scrap, rework, digest in jobs]
+                [future.result() for future in futures]
+        else:
+            for model, model_points, scrap, rework, digest in jobs:
+                _render_model_charts(model, model_points, scrap, rework, out_dir, file_format)
+        
+        cache.update({f"{model}.{file_format}": digest for model, model_points, scrap, rework, digest in jobs})
+        with open(cache_path, 'w') as cache_file:
+            json.dump(cache, cache_file, indent = 4, sort_keys = True)
+        return [i[0] for i in jobs]
+        
+    def _generate_yield_chart(self, model, spc = None, show = True):
+        if spc is None:
+            spc = self.compute_yield_spc(models = [model])
+        points = spc['points'][spc['points']['model'] == model]
 
-        x = [str(i[0]) for i in yield_list]
-        y = yield_percents
+        x = points['num'].astype(str)
+        y = points['yield']
 
         fig = go.Figure()
 
@@ -560,9 +1540,13 @@ class RSLManager:
             y=y,
             mode='markers+lines',
             marker=dict(color='blue'),
-            text=[f"Shop Order: {so[0]}<br>Yield: {y[i]:.2f}%" for i, so in enumerate(yield_list)],
-            hoverinfo='text'
+            text=[f"Shop Order: {num}<br>Yield: {value:.2f}%" for num, value in zip(points['num'], y)],
+            hoverinfo='text',
+            name='Yield'
         ))
+        
+        for column, color in [('center', 'green'), ('ucl', 'red'), ('lcl', 'red')]:
+            fig.add_trace(go.Scatter(x=x, y=points[column], mode='lines', line=dict(color=color, dash='dash'), name=column.upper()))
 
         fig.update_layout(
             title=f"{model} Shop Order Yield",
@@ -570,17 +1554,380 @@ class RSLManager:
             yaxis_title='Yield (%)',
         )
 
-        fig.show()
+        if show:
+            fig.show()
+        return fig
+        
+    # SUMMARY FUNCTIONS
+    def _create_summary_tables(self):
+        # ScrapSummary is RSL pre-aggregated per model/plant/log/code and week, month and quarter bucket
+        # (bucket = ISO date the bucket starts on). Watermarks marks that it was built from the dirty shop orders.
+        self.curr.execute(
+            """
+            CREATE TABLE IF NOT EXISTS ScrapSummary (
+            bucket_type TEXT NOT NULL,
+            model VARCHAR(5) NOT NULL,
+            bucket DATE NOT NULL,
+            log_type TEXT NOT NULL,
+            plant TEXT NOT NULL,
+            code_id INTEGER(3) NOT NULL,
+            qty NUMERIC NOT NULL,
+            cost REAL NOT NULL,
+            PRIMARY KEY (bucket_type, model, bucket, log_type, plant, code_id)
+            ) WITHOUT ROWID
+            """
+        )
+        
+        self.curr.execute(
+            """
+            CREATE TABLE IF NOT EXISTS Watermarks (
+            name TEXT PRIMARY KEY NOT NULL,
+            value INTEGER NOT NULL
+            )
+            """
+        )
+        
+    def refresh_summary(self, shoporders = None, full = False):
+        # Re-aggregates ScrapSummary for the shop orders loads marked dirty (plus any passed in, everything if full = True).
+        # A bucket holds every shop order of its model, so each bucket a dirty shop order has RSL rows in is deleted and summed
+        # again from all of the model's rows in the months it covers. A database summarized before this rebuilds once.
+        self._create_summary_tables()
+        self.curr.execute("""SELECT value FROM Watermarks WHERE name = 'ScrapSummaryShopOrders'""")
+        full = full or self.curr.fetchone() is None
+        predicate, params = self._dirty_filter('summary', shoporders, full)
+        dirty = self._classify_rsl(dirty = (predicate, params))
+        dirty_dates = pd.to_datetime(dirty['date'], format = '%Y-%m-%d', errors = 'coerce')
+        dirty = dirty[dirty_dates.notna()]
+        dirty_dates = dirty_dates[dirty_dates.notna()]
+        
+        if full:
+            self.curr.execute("""DELETE FROM ScrapSummary""")
+            rows, dates = dirty, dirty_dates
+        else:
+            # months spanned by the weeks and quarters the dirty rows fall in
+            weeks = dirty_dates.dt.normalize() - pd.to_timedelta(dirty_dates.dt.weekday, unit = 'D')
+            quarters = dirty_dates.dt.to_period('Q').dt.start_time
+            months = pd.concat([weeks, weeks + pd.Timedelta(days = 6)] + [quarters + pd.DateOffset(months = i) for i in range(3)]).dt.strftime('%Y-%m').unique()
+            rows = self._classify_rsl(months = list(months)) if len(months) else dirty
+            rows = rows[rows['model'].isin(dirty['model'].unique())]
+            dates = pd.to_datetime(rows['date'], format = '%Y-%m-%d', errors = 'coerce')
+            rows = rows[dates.notna()]
+            dates = dates[dates.notna()]
+        
+        summary = []
+        for bucket_type in SUMMARY_BUCKETS:
+            bucketed = rows.assign(bucket_type = bucket_type, bucket = _bucket_start(dates, bucket_type))
+            if not full:
+                affected = set(zip(dirty['model'], _bucket_start(dirty_dates, bucket_type)))
+                bucketed = bucketed[pd.MultiIndex.from_arrays([bucketed['model'], bucketed['bucket']]).isin(affected)]
+                self.curr.executemany("""DELETE FROM ScrapSummary WHERE bucket_type = ? AND model = ? AND bucket = ?""", [(bucket_type, ) + i for i in affected])
+            summary.append(bucketed.groupby(['bucket_type', 'model', 'bucket', 'log_type', 'plant', 'code_id'], as_index = False)[['qty', 'cost']].sum())
+        summary = pd.concat(summary)
+        
+        self.curr.executemany("""INSERT INTO ScrapSummary (bucket_type, model, bucket, log_type, plant, code_id, qty, cost) VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", _to_records(summary))
+        self._clear_dirty('summary')
+        self.curr.execute("""DELETE FROM Watermarks WHERE name = 'ScrapSummary'""")
+        self.curr.execute("""INSERT OR REPLACE INTO Watermarks (name, value) VALUES ('ScrapSummaryShopOrders', 1)""")
+        
+    def _classify_rsl(self, model = None, start_date = None, end_date = None, dirty = None, months = None):
+        # RSL rows tagged with the log they count towards, using the same rules as the scrap and rework stages: full device
+        # scrap is ProdScrap (DM1) or QCScrap (QC-DM1), hub components outside the excluded codes are ProdRework at half quantity.
+        # Rows that belong to no log are dropped. A date range is read through the RSL_date index, months through RSL_month and
+        # dirty is a (predicate on {shoporder}, params) pair from _dirty_filter.
+        filters = []
+        params = []
+        # the ShopOrders first/last dates skip shop orders with no activity in the range before RSL is touched
+        for condition, value in [("""LapFusionModels.model = ?""", model), ("""RSL.date >= ? AND ShopOrders.last_date >= ?""", start_date), ("""RSL.date <= ? AND ShopOrders.first_date <= ?""", end_date)]:
+            if value is not None:
+                filters.append(condition)
+                params.extend([value] if condition.startswith('LapFusionModels') else [pd.Timestamp(value).strftime('%Y-%m-%d')] * 2)
+        if dirty is not None:
+            filters.append(dirty[0].format(shoporder = 'RSL.so'))
+            params.extend(dirty[1])
+        if months is not None:
+            filters.append(f"""RSL.month IN ({', '.join(['?'] * len(months))})""")
+            params.extend(months)
+        df = self._read_sql(
+            f"""
+            SELECT RSL.id, RSL.date, RSL.so, RSL.component_pn, RSL.scrap_code AS code_id, RSL.scrap_qty AS qty, RSL.cost, RSL.plant,
+            ShopOrders.tl_pn, LapFusionModels.model
+            FROM RSL
+            INNER JOIN ShopOrders ON ShopOrders.num = RSL.so
+            INNER JOIN LapFusionModels ON LapFusionModels.tl_pn = ShopOrders.tl_pn
+            {'WHERE ' + ' AND '.join(filters) if filters else ''}
+            """, params)
+        references = self._get_references()
+        hub_pns = set([component_pn for (component_pn, tl_pn), description in references['components'].items() if description in self.hub_descriptions])
+        names = df['code_id'].map(references['codes'])
+        
+        full_device = df['component_pn'] == df['tl_pn']
+        rework = ~full_device & df['component_pn'].isin(hub_pns) & ~names.isin(self.rework_excluded_codes)
+        df['log_type'] = np.select([full_device & (df['plant'] == 'DM1'), full_device & (df['plant'] == 'QC-DM1'), rework], ['ProdScrap', 'QCScrap', 'ProdRework'], '')
+        df['qty'] = df['qty'].where(df['log_type'] != 'ProdRework', df['qty'] / 2)
+        df['cost'] = df['cost'].fillna(0)
+        return df[(df['log_type'] != '') & names.notna()].reset_index(drop = True)
+        
+    def _get_model_summary(self, model, start_date = None, end_date = None, bucket = 'month', log_type = None, plant = None):
+        # Scrap/rework qty and cost per bucket, log, plant and code name from ScrapSummary. model = None returns all
+        # models, start_date/end_date keep the buckets that overlap the range. Sorted so each bucket reads as a Pareto.
+        self._create_summary_tables()
+        filters = ["""ScrapSummary.bucket_type = ?"""]
+        params = [bucket]
+        for column, value in [('model', model), ('log_type', log_type), ('plant', plant)]:
+            if value is not None:
+                filters.append(f"""ScrapSummary.{column} = ?""")
+                params.append(value)
+        if start_date is not None:
+            filters.append("""ScrapSummary.bucket >= ?""")
+            params.append(_bucket_start(pd.Series([pd.Timestamp(start_date)]), bucket)[0])
+        if end_date is not None:
+            filters.append("""ScrapSummary.bucket <= ?""")
+            params.append(pd.Timestamp(end_date).strftime('%Y-%m-%d'))
+        
+        return self._read_sql(
+            f"""
+            SELECT ScrapSummary.model, ScrapSummary.bucket, ScrapSummary.log_type, ScrapSummary.plant, codes.name AS code,
+            SUM(ScrapSummary.qty) AS qty, SUM(ScrapSummary.cost) AS cost
+            FROM ScrapSummary
+            INNER JOIN ({SCRAP_CODE_NAMES}) AS codes ON codes.id = ScrapSummary.code_id
+            WHERE {' AND '.join(filters)}
+            GROUP BY ScrapSummary.model, ScrapSummary.bucket, ScrapSummary.log_type, ScrapSummary.plant, codes.name
+            ORDER BY ScrapSummary.model, ScrapSummary.bucket, ScrapSummary.log_type, qty DESC
+            """, params)
+        
+        
+        
+        
         
-    def _get_model_summary(self, model, start_date = None, end_date = None):
-        self.curr.execute("""SELECT num FROM ShopOrders JOIN LapFusionModels ON LapFusionModels.tl_pn = ShopOrders.tl_pn WHERE LapFusionModels.model = ?""", (model, ))
-        shoporders = sorted([i[0] for i in self.curr.fetchall()])
-        # print(shoporders)
         
+    def get_scrap_by_date(self, model = None, start_date = None, end_date = None, weeks = None):
+        # Scrap/rework qty and cost per log and code name for an exact date range straight from RSL (ScrapSummary is
+        # bucket granular). weeks = N is the N weeks up to end_date (default: the latest RSL date), e.g. last 13 weeks of EB215.
+        if weeks is not None:
+            if end_date is None:
+                self.curr.execute("""SELECT MAX(date) FROM RSL WHERE month IS NOT NULL""")
+                end_date = self.curr.fetchone()[0]
+            if end_date is not None:
+                start_date = pd.Timestamp(end_date) - pd.Timedelta(weeks = weeks) + pd.Timedelta(days = 1)
+        df = self._classify_rsl(model = model, start_date = start_date, end_date = end_date)
+        df['code'] = df['code_id'].map(self._get_references()['codes'])
+        df = df.groupby(['model', 'log_type', 'code'], as_index = False)[['qty', 'cost']].sum()
+        return df.sort_values(['model', 'log_type', 'qty'], ascending = [True, True, False], kind = 'stable').reset_index(drop = True)
         
+    def get_cost_pareto(self, by = 'code', model = None, start_date = None, end_date = None, log_type = None, top = None):
+        # Cost-ranked Pareto with share and cumulative share of the total $. by = 'code', 'model', 'plant' or 'log_type' come
+        # from ScrapSummary (monthly buckets, so the date range is month granular), by = 'shoporder' from the classified RSL rows
+        # (exact dates, scrap_qty/rework_qty/cost only count the log_type asked for).
+        if by == 'shoporder':
+            df = self._classify_rsl(model = model, start_date = start_date, end_date = end_date)
+            if log_type is not None:
+                df = df[df['log_type'] == log_type]
+            rework = df['log_type'] == 'ProdRework'
+            df = df.assign(shoporder = df['so'], scrap_qty = df['qty'].where(~rework, 0), rework_qty = df['qty'].where(rework, 0))
+            df = df.groupby(['shoporder', 'model'], as_index = False)[['scrap_qty', 'rework_qty', 'cost']].sum()
+        else:
+            df = self._get_model_summary(model, start_date, end_date, bucket = 'month', log_type = log_type)
+            df = df.groupby(by, as_index = False)[['qty', 'cost']].sum()
         
+        df = df.sort_values('cost', ascending = False, kind = 'stable').reset_index(drop = True)
+        df['share'] = df['cost'] / df['cost'].sum() * 100
+        df['cumulative'] = df['share'].cumsum()
+        return df.head(top) if top else df
+        
+    # YIELD REPORT FUNCTIONS
+    def load_yield_reports(self, report_dir, workers = None):
+        # Loads every 'Energy Yield Report' workbook in report_dir. YieldReports keeps each file's sha1, so only new or
+        # changed workbooks are parsed again. Office lock files (~$...) are skipped.
+        self._create_yieldreport_tables()
+        files = sorted([os.path.join(report_dir, i) for i in os.listdir(report_dir) if i.lower().endswith('.xlsx') and not i.startswith('~$')])
+        
+        self.curr.execute("""SELECT source, sha1 FROM YieldReports""")
+        loaded = dict(self.curr.fetchall())
+        hashes = dict([(file_path, _file_hash(file_path)) for file_path in files])
+        changed = [i for i in files if loaded.get(os.path.basename(i)) != hashes[i]]
+        if not changed:
+            print("Yield reports: no new or changed workbooks")
+            return
+        
+        with ProcessPoolExecutor(max_workers = workers or min(len(changed), os.cpu_count())) as pool:
+            futures = [pool.submit(_read_yield_report, file_path) for file_path in changed]
+            for file_path, future in zip(changed, futures):
+                shoporders, scrap, unrecognised = future.result()
+                for sheet in unrecognised:
+                    print(f"Yield reports: {os.path.basename(file_path)} sheet '{sheet}' has shop order rows but no recognised header, skipped")
+                self._write_yield_report(file_path, hashes[file_path], shoporders, scrap)
+        print(f"Yield reports: {len(changed)} workbooks loaded")
+        
+        self.commit_changes()
+        
+    def _create_yieldreport_tables(self):
+        self.curr.execute(
+            """
+            CREATE TABLE IF NOT EXISTS YieldReports (
+            source TEXT PRIMARY KEY NOT NULL,
+            sha1 TEXT NOT NULL,
+            quarter TEXT,
+            shoporders INTEGER NOT NULL,
+            loaded_at TEXT NOT NULL
+            )
+            """
+        )
+        self.curr.execute(
+            """
+            CREATE TABLE IF NOT EXISTS YieldReportShopOrders (
+            shoporder INTEGER(7) NOT NULL,
+            source TEXT NOT NULL,
+            model VARCHAR(5) NOT NULL,
+            sheet TEXT,
+            so_qty INTEGER,
+            build_qty INTEGER,
+            good_qty INTEGER,
+            yield_pct REAL,
+            date DATE,
+            PRIMARY KEY (shoporder, source),
+            FOREIGN KEY(shoporder) REFERENCES ShopOrders(num),
+            FOREIGN KEY(source) REFERENCES YieldReports(source)
+            )
+            """
+        )
+        self.curr.execute(
+            """
+            CREATE TABLE IF NOT EXISTS YieldReportScrap (
+            shoporder INTEGER(7) NOT NULL,
+            source TEXT NOT NULL,
+            description TEXT NOT NULL,
+            qty NUMERIC NOT NULL,
+            PRIMARY KEY (shoporder, source, description),
+            FOREIGN KEY(shoporder) REFERENCES ShopOrders(num),
+            FOREIGN KEY(source) REFERENCES YieldReports(source)
+            )
+            """
+        )
+        
+    def _write_yield_report(self, file_path, sha1, shoporders, scrap):
+        # A changed workbook replaces everything that was loaded from it before
+        source = os.path.basename(file_path)
+        quarter = re.search(r'(\d{4})\s*Q([1-4])', source)
+        for table in ['YieldReportScrap', 'YieldReportShopOrders']:
+            self.curr.execute(f"""DELETE FROM {table} WHERE source = ?""", (source, ))
+        
+        # a shop order listed twice in one workbook keeps its first block
+        shoporders = shoporders.drop_duplicates('shoporder').assign(source = source)
+        self.curr.executemany(
+            """INSERT INTO YieldReportShopOrders (shoporder, model, sheet, so_qty, build_qty, good_qty, yield_pct, date, source) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            _to_records(shoporders))
+        scrap = scrap[scrap['shoporder'].isin(shoporders['shoporder'])].drop_duplicates(['shoporder', 'description']).assign(source = source)
+        self.curr.executemany("""INSERT INTO YieldReportScrap (shoporder, description, qty, source) VALUES (?, ?, ?, ?)""", _to_records(scrap))
+        self.curr.execute(
+            """INSERT INTO YieldReports (source, sha1, quarter, shoporders, loaded_at) VALUES (?, ?, ?, ?, datetime('now'))
+            ON CONFLICT(source) DO UPDATE SET sha1 = excluded.sha1, quarter = excluded.quarter, shoporders = excluded.shoporders, loaded_at = excluded.loaded_at""",
+            (source, sha1, f"{quarter.group(1)}-Q{quarter.group(2)}" if quarter else None, len(shoporders)))
+        
+    def get_yield_reconciliation(self, models = None, by = 'quarter'):
+        # Report yield (good / build qty) against the pipeline's yield ((so_qty - scrap_qty) / so_qty, as in compute_yield_spc)
+        # for the shop orders in each report. by = 'quarter' rolls up per report model and quarter, by = 'shoporder' lists each one.
+        # Shop orders missing from ShopOrders count in 'shoporders' but not in 'matched', and both yields only cover the matched ones
+        # so 'difference' compares the same shop orders (NaN for a quarter with none matched).
+        self._create_yieldreport_tables()
+        df = self._read_sql(
+            """
+            SELECT YieldReports.quarter, Report.model, Report.shoporder, LapFusionModels.model AS rsl_model,
+            Report.build_qty, Report.good_qty, Report.yield_pct AS report_yield, ShopOrders.so_qty, ShopOrders.scrap_qty
+            FROM YieldReportShopOrders AS Report
+            INNER JOIN YieldReports ON YieldReports.source = Report.source
+            LEFT JOIN ShopOrders ON ShopOrders.num = Report.shoporder
+            LEFT JOIN LapFusionModels ON LapFusionModels.tl_pn = ShopOrders.tl_pn
+            """)
+        if models is not None:
+            df = df[df['model'].isin(models)]
+        matched = df['so_qty'] > 0
+        df['computed_yield'] = ((df['so_qty'] - df['scrap_qty']) / df['so_qty'] * 100).where(matched)
+        
+        if by == 'shoporder':
+            df['difference'] = df['report_yield'] - df['computed_yield']
+            return df.sort_values(['quarter', 'model', 'shoporder']).reset_index(drop = True)
+        
+        df['matched'] = matched
+        quantities = ['build_qty', 'good_qty', 'so_qty', 'scrap_qty']
+        df[quantities] = df[quantities].astype('float64').where(matched, 0)
+        summary = df.groupby(['model', 'quarter'], as_index = False).agg(
+            shoporders = ('shoporder', 'size'), matched = ('matched', 'sum'), build_qty = ('build_qty', 'sum'), good_qty = ('good_qty', 'sum'),
+            so_qty = ('so_qty', 'sum'), scrap_qty = ('scrap_qty', 'sum'))
+        summary['report_yield'] = (summary['good_qty'] / summary['build_qty'] * 100).where(summary['build_qty'] > 0)
+        summary['computed_yield'] = ((summary['so_qty'] - summary['scrap_qty']) / summary['so_qty'] * 100).where(summary['so_qty'] > 0)
+        summary['difference'] = summary['report_yield'] - summary['computed_yield']
+        return summary[['model', 'quarter', 'shoporders', 'matched', 'report_yield', 'computed_yield', 'difference']]
+        
+    # CUBE FUNCTIONS
+    def build_scrap_cube(self, out_dir = None):
+        # Dense float32 qty and cost arrays indexed (shop order, log type, code name) from ScrapFacts, plus side arrays
+        # for model, so_qty, type and first date, saved as .npy for load_scrap_cube. Every build gets its own directory
+        # and out_dir/current is swapped to it once complete, so a reader always gets arrays and meta from the same build.
+        # The previous build is kept for readers that opened current just before the swap, older ones are removed.
+        out_dir = out_dir or os.path.join(os.getcwd(), 'results', 'cube')
+        build_id = f"{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        build_dir = os.path.join(out_dir, build_id)
+        os.makedirs(build_dir)
+        shoporders = self._read_sql(
+            """
+            SELECT ShopOrders.num, COALESCE(LapFusionModels.model, '') AS model, ShopOrders.so_qty, COALESCE(ShopOrders.type, '') AS type, ShopOrders.first_date
+            FROM ShopOrders
+            LEFT JOIN LapFusionModels ON LapFusionModels.tl_pn = ShopOrders.tl_pn
+            ORDER BY model, ShopOrders.num
+            """)
+        facts = self._read_sql("""SELECT shoporder, log_type, code_id, qty, cost FROM ScrapFacts""")
+        
+        code_names = self._get_references()['codes']
+        codes = sorted(set(code_names.values()))
+        models = sorted(shoporders['model'].unique())
+        types = sorted(shoporders['type'].unique())
+        
+        facts = facts[facts['code_id'].isin(code_names) & facts['log_type'].isin(CUBE_LOG_TYPES)]
+        index = (
+            pd.Index(shoporders['num']).get_indexer(facts['shoporder']),
+            pd.Index(CUBE_LOG_TYPES).get_indexer(facts['log_type']),
+            pd.Index(codes).get_indexer(facts['code_id'].map(code_names)),
+        )
+        shape = (len(shoporders), len(CUBE_LOG_TYPES), len(codes))
+        arrays = {'qty': np.zeros(shape, dtype = np.float32), 'cost': np.zeros(shape, dtype = np.float32)}
+        # several code ids can share a name, add.at sums them into the same cell
+        np.add.at(arrays['qty'], index, facts['qty'].to_numpy(dtype = np.float32))
+        np.add.at(arrays['cost'], index, facts['cost'].to_numpy(dtype = np.float32))
+        arrays['shoporders'] = shoporders['num'].to_numpy(dtype = np.int64)
+        arrays['model'] = pd.Index(models).get_indexer(shoporders['model']).astype(np.int16)
+        arrays['so_qty'] = shoporders['so_qty'].to_numpy(dtype = np.float64)
+        arrays['type'] = pd.Index(types).get_indexer(shoporders['type']).astype(np.int8)
+        arrays['first_date'] = pd.to_datetime(shoporders['first_date'], format = '%Y-%m-%d', errors = 'coerce').to_numpy(dtype = 'datetime64[D]')
         
+        bounds = np.searchsorted(arrays['model'], np.arange(len(models) + 1))
+        meta = {
+            'codes': codes,
+            'log_types': CUBE_LOG_TYPES,
+            'models': dict([(model, [int(bounds[i]), int(bounds[i + 1])]) for i, model in enumerate(models)]),
+            'types': types,
+            'shapes': dict([(name, list(arrays[name].shape)) for name in CUBE_ARRAYS]),
+            'build_id': build_id,
+            'built_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'database': self.name,
+        }
+        for name in CUBE_ARRAYS:
+            np.save(os.path.join(build_dir, f"{name}.npy"), arrays[name])
+        with open(os.path.join(build_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent = 2)
         
+        pointer = os.path.join(out_dir, 'current')
+        previous = None
+        if os.path.exists(pointer):
+            with open(pointer) as f:
+                previous = f.read().strip()
+        with open(f"{pointer}.tmp", 'w') as f:
+            f.write(build_id)
+        os.replace(f"{pointer}.tmp", pointer)
+        for name in os.listdir(out_dir):
+            if os.path.isdir(os.path.join(out_dir, name)) and name not in [build_id, previous]:
+                # a build still memory mapped on Windows can't be removed yet, the next build tries again
+                shutil.rmtree(os.path.join(out_dir, name), ignore_errors = True)
+        return meta
         
     # CHECKING FUNCTION
         def checking_function(self, shoporder, component_pn):